@@ -0,0 +1,242 @@
+import fnmatch
+import json
+import logging
+import numbers
+import time
+from threading import Lock
+
+from scheduler import shared_scheduler
+
+logger = logging.getLogger(__name__)
+
+FUNCTIONS = ["min", "max", "mean", "count", "last"]
+
+numpy = None  # imported when the first Aggregator is created, it slows down the start when aggregation is not used
+
+# Reduces the resolution of device telemetry before it is sent to Thingsboard. Rules match device names and telemetry
+# keys using shell-style patterns, the first matching rule is used:
+#
+#   {"rules": [
+#     {"device": "*", "key": "lb", "window": 60, "functions": ["min", "max", "mean"]},
+#     {"device": "4237*", "key": "temperature", "window": 300},
+#     {"key": "alarm", "pass_through": true}
+#   ]}
+#
+# Keys matching no rule, or a pass_through rule, are sent as they are. Numeric values of the other keys are aggregated
+# over tumbling windows of the given number of seconds, aligned to the epoch, and only the aggregates are sent when the
+# window is closed, as "<key>_min", "<key>_max", "<key>_mean" and "<key>_count". The last value keeps the name of the key,
+# so existing dashboards keep working.
+
+
+class Rule:
+    def __init__(self, device="*", key="*", window=60, functions=None, pass_through=False):
+        self.device = device
+        self.key = key
+        self.window_ms = int(window * 1000)
+        self.functions = functions or FUNCTIONS
+        self.pass_through = pass_through
+        for function in self.functions:
+            if function not in FUNCTIONS:
+                raise ValueError("unknown aggregation function {}".format(function))
+
+    def matches(self, device, key):
+        return fnmatch.fnmatchcase(device, self.device) and fnmatch.fnmatchcase(key, self.key)
+
+
+def _import_numpy():
+    global numpy
+    if numpy is None:
+        try:
+            import numpy as module
+        except ImportError:
+            return
+
+        numpy = module
+
+
+def load_rules(path):
+    with open(path) as f:
+        config = json.load(f)
+
+    return [Rule(**rule) for rule in config["rules"]]
+
+
+class _Series:
+    """
+    The samples of one key of a device in the current window. Samples are stored in a fixed size buffer, which is
+    reduced to partial aggregates when it is full, so the memory used does not depend on the number of samples.
+    """
+    __slots__ = ["window_start", "values", "size", "count", "min", "max", "sum", "last"]
+
+    def __init__(self, capacity, window_start):
+        self.window_start = window_start
+        self.values = numpy.empty(capacity) if numpy is not None else [0.0] * capacity
+        self.size = 0
+        self.count = 0
+        self.min = None
+        self.max = None
+        self.sum = 0.0
+        self.last = None
+
+    def add(self, value):
+        self.values[self.size] = value
+        self.size += 1
+        self.last = value
+        if self.size == len(self.values):
+            self.reduce()
+
+    def reduce(self):
+        if self.size == 0:
+            return
+
+        samples = self.values[:self.size]
+        if numpy is not None:
+            low, high, total = float(samples.min()), float(samples.max()), float(samples.sum())
+        else:
+            low, high, total = min(samples), max(samples), sum(samples)
+
+        self.min = low if self.min is None else min(self.min, low)
+        self.max = high if self.max is None else max(self.max, high)
+        self.sum += total
+        self.count += self.size
+        self.size = 0
+
+    def result(self, key, functions):
+        self.reduce()
+        values = {}
+        for function in functions:
+            if function == "last":
+                values[key] = self.last
+            elif function == "mean":
+                values[key + "_mean"] = self.sum / self.count
+            else:
+                values[key + "_" + function] = getattr(self, function)
+
+        return values
+
+
+class Aggregator:
+    """
+    Aggregates device telemetry according to the rules. add() returns the values which are not aggregated, the aggregates
+    of closed windows are passed to publish_callback(device, window start in ms, values). Windows are closed when a sample
+    of a later window arrives, or by a job on the scheduler checking every check_interval seconds. A sample of a window
+    which is already closed (received late, by a parallel parse worker for example) is passed through as it is, so a
+    window is never published twice.
+    """
+    def __init__(self, rules, publish_callback, buffer_size=64, check_interval_seconds=1, scheduler=None):
+        _import_numpy()
+        self.rules = rules
+        self.publish_callback = publish_callback
+        self.buffer_size = buffer_size
+        self.check_interval = check_interval_seconds
+        self.rule_cache = {}  # (device, key) -> rule or None
+        self.series = {}  # (device, key) -> _Series
+        self.closed = {}  # (device, key) -> start of the last closed window
+        self.lock = Lock()
+        self.scheduler = scheduler if scheduler is not None else shared_scheduler()
+        self.job = None
+        self.samples = 0
+        self.late = 0
+        self.published = 0
+
+    def start(self):
+        self.job = self.scheduler.call_every(self.check_interval, self.run, "aggregation")
+
+    def stop(self):
+        if self.job is not None:
+            self.job.cancel()
+            self.job = None
+
+        self.flush()
+
+    def rule_for(self, device, key):
+        cache_key = (device, key)
+        try:
+            return self.rule_cache[cache_key]
+        except KeyError:
+            rule = None
+            for candidate in self.rules:
+                if candidate.matches(device, key):
+                    rule = candidate if not candidate.pass_through else None
+                    break
+
+            self.rule_cache[cache_key] = rule
+            return rule
+
+    def add(self, device, timestamp, values):
+        passed = {}
+        closed = []
+        with self.lock:
+            for key, value in values.items():
+                rule = self.rule_for(device, key)
+                if rule is None or isinstance(value, bool) or not isinstance(value, numbers.Real):
+                    passed[key] = value
+                    continue
+
+                window_start = timestamp - timestamp % rule.window_ms
+                series = self.series.get((device, key))
+                last_closed = self.closed.get((device, key))
+                if (series is not None and window_start < series.window_start) or \
+                        (last_closed is not None and window_start <= last_closed):
+                    passed[key] = value
+                    self.late += 1
+                    continue
+
+                if series is not None and series.window_start != window_start:
+                    closed.append((device, key, rule, self.close((device, key))))
+                    series = None
+
+                if series is None:
+                    series = self.series[(device, key)] = _Series(self.buffer_size, window_start)
+
+                series.add(value)
+                self.samples += 1
+
+        self.publish(closed)
+        return passed
+
+    def passthrough(self, device, values):
+        """ returns the values which are not aggregated, without recording the others """
+        with self.lock:
+            return dict((key, value) for key, value in values.items() if self.rule_for(device, key) is None)
+
+    def close_expired(self, now_ms):
+        closed = []
+        with self.lock:
+            for (device, key), series in list(self.series.items()):
+                rule = self.rule_for(device, key)
+                if series.window_start + rule.window_ms <= now_ms:
+                    closed.append((device, key, rule, self.close((device, key))))
+
+        self.publish(closed)
+
+    def close(self, series_key):
+        # called with the lock held
+        series = self.series.pop(series_key)
+        self.closed[series_key] = series.window_start
+        return series
+
+    def flush(self):
+        with self.lock:
+            closed = [(device, key, self.rule_for(device, key), series) for (device, key), series in self.series.items()]
+            for (device, key), series in self.series.items():
+                self.closed[(device, key)] = series.window_start
+            self.series = {}
+
+        self.publish(closed)
+
+    def publish(self, closed):
+        # aggregates of the keys of a device closed at the same time are sent together
+        messages = {}
+        for device, key, rule, series in closed:
+            messages.setdefault((device, series.window_start), {}).update(series.result(key, rule.functions))
+
+        for (device, window_start), values in sorted(messages.items()):
+            self.published += 1
+            try:
+                self.publish_callback(device, window_start, values)
+            except Exception:
+                logger.exception("Could not publish aggregated telemetry of {}".format(device))
+
+    def run(self):
+        self.close_expired(int(round(time.time() * 1000)))
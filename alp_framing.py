@@ -0,0 +1,349 @@
+#!/usr/bin/env python
+"""
+Compact binary framing of raw ALP commands, used for the binary uplink in save bandwidth mode.
+
+Many frames received by one modem are packed in a single blob:
+
+  header:  magic (2 bytes) | version (1) | flags (1) | dictionary ID (4) | body length (4)
+  body:    modem UID length (1) | modem UID | base timestamp in ms (8) | number of frames (varint)
+           per frame: timestamp delta in ms to the previous frame (zigzag varint) | length (varint) | ALP command
+
+All integers in the header are big endian. The body is compressed with zlib or zstd as indicated by the flags, optionally
+using a preset dictionary trained on typical ALP frames. The dictionary ID is the CRC32 of the dictionary, so a decoder
+can check it uses the same dictionary as the gateway. Because the body length is included, blobs can be concatenated.
+
+The module can be used by the backend to decode blobs, and to train a dictionary from recorded frames:
+
+  $ python alp_framing.py train frames.hex alp.dict
+  $ python alp_framing.py decode blob.bin --dictionary alp.dict
+"""
+
+import argparse
+import binascii
+import logging
+import struct
+import sys
+import zlib
+from threading import Lock
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b"\xd7\xa1"
+VERSION = 1
+HEADER = struct.Struct(">2sBBII")
+TIMESTAMP = struct.Struct(">Q")
+
+COMPRESSION_NONE = "none"
+COMPRESSION_ZLIB = "zlib"
+COMPRESSION_ZSTD = "zstd"
+COMPRESSION_METHODS = [COMPRESSION_NONE, COMPRESSION_ZLIB, COMPRESSION_ZSTD]
+
+_COMPRESSION_FLAGS = {COMPRESSION_NONE: 0, COMPRESSION_ZLIB: 1, COMPRESSION_ZSTD: 2}
+_FLAG_COMPRESSION_MASK = 0x0f
+FLAG_DICTIONARY = 0x10
+
+# zlib only supports preset dictionaries on python 3.3 and later, on older versions the body is compressed without
+ZLIB_DICTIONARY_SUPPORTED = sys.version_info >= (3, 3)
+
+
+def _zstandard():
+    # only imported when zstd is used, not when the gateway starts
+    try:
+        import zstandard
+    except ImportError:
+        return None
+
+    return zstandard
+
+
+def dictionary_id(dictionary):
+    return binascii.crc32(dictionary) & 0xffffffff
+
+
+def _write_varint(out, value):
+    while value >= 0x80:
+        out.append((value & 0x7f) | 0x80)
+        value >>= 7
+
+    out.append(value)
+
+
+def _read_varint(data, pos):
+    value = 0
+    shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        value |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return value, pos
+
+        shift += 7
+
+
+def _zigzag(value):
+    return value * 2 if value >= 0 else -value * 2 - 1
+
+
+def _unzigzag(value):
+    return value >> 1 if value & 1 == 0 else -(value >> 1) - 1
+
+
+def _compress(body, compression, dictionary):
+    """ returns the compressed body and its flags, the dictionary is only used when it is supported """
+    if compression == COMPRESSION_ZSTD:
+        zstandard = _zstandard()
+        if zstandard is None:
+            raise ValueError("zstd compression requires the zstandard package")
+
+        if dictionary:
+            compressor = zstandard.ZstdCompressor(dict_data=zstandard.ZstdCompressionDict(dictionary))
+            return compressor.compress(body), _COMPRESSION_FLAGS[COMPRESSION_ZSTD] | FLAG_DICTIONARY
+
+        return zstandard.ZstdCompressor().compress(body), _COMPRESSION_FLAGS[COMPRESSION_ZSTD]
+
+    if compression == COMPRESSION_ZLIB:
+        if dictionary and ZLIB_DICTIONARY_SUPPORTED:
+            compressor = zlib.compressobj(9, zlib.DEFLATED, zlib.MAX_WBITS, 9, zlib.Z_DEFAULT_STRATEGY, dictionary)
+            return compressor.compress(body) + compressor.flush(), _COMPRESSION_FLAGS[COMPRESSION_ZLIB] | FLAG_DICTIONARY
+
+        return zlib.compress(body, 9), _COMPRESSION_FLAGS[COMPRESSION_ZLIB]
+
+    if compression == COMPRESSION_NONE:
+        return body, _COMPRESSION_FLAGS[COMPRESSION_NONE]
+
+    raise ValueError("unknown compression method {}".format(compression))
+
+
+def _decompress(body, flags, dictionary):
+    method = flags & _FLAG_COMPRESSION_MASK
+    if flags & FLAG_DICTIONARY and not dictionary:
+        raise ValueError("blob was compressed with a dictionary, but no dictionary was given")
+
+    if method == _COMPRESSION_FLAGS[COMPRESSION_NONE]:
+        return body
+
+    if method == _COMPRESSION_FLAGS[COMPRESSION_ZLIB]:
+        if flags & FLAG_DICTIONARY:
+            decompressor = zlib.decompressobj(zlib.MAX_WBITS, dictionary)
+            return decompressor.decompress(body) + decompressor.flush()
+
+        return zlib.decompress(body)
+
+    if method == _COMPRESSION_FLAGS[COMPRESSION_ZSTD]:
+        zstandard = _zstandard()
+        if zstandard is None:
+            raise ValueError("decoding zstd compressed blobs requires the zstandard package")
+
+        if flags & FLAG_DICTIONARY:
+            return zstandard.ZstdDecompressor(dict_data=zstandard.ZstdCompressionDict(dictionary)).decompressobj().decompress(body)
+
+        return zstandard.ZstdDecompressor().decompressobj().decompress(body)
+
+    raise ValueError("unknown compression flags {:#x}".format(flags))
+
+
+def encode_frames(modem_uid, frames, compression=COMPRESSION_ZLIB, dictionary=None):
+    """ packs a list of (timestamp in ms, ALP command bytes) tuples received by a modem in one blob """
+    uid = modem_uid.encode("utf-8")
+    if len(uid) > 255:
+        raise ValueError("modem UID too long")
+
+    body = bytearray([len(uid)])
+    body += uid
+    base_timestamp = frames[0][0] if frames else 0
+    body += TIMESTAMP.pack(base_timestamp)
+    _write_varint(body, len(frames))
+    previous = base_timestamp
+    for timestamp, data in frames:
+        _write_varint(body, _zigzag(timestamp - previous))
+        _write_varint(body, len(data))
+        body += data
+        previous = timestamp
+
+    body = bytes(body)
+    compressed, flags = _compress(body, compression, dictionary)
+    if len(compressed) >= len(body):
+        # small batches can grow when compressed
+        compressed, flags = body, _COMPRESSION_FLAGS[COMPRESSION_NONE]
+
+    used_dictionary_id = dictionary_id(dictionary) if flags & FLAG_DICTIONARY else 0
+    return HEADER.pack(MAGIC, VERSION, flags, used_dictionary_id, len(compressed)) + compressed
+
+
+def decode_frames(blob, dictionary=None):
+    """ returns the modem UID and the list of (timestamp in ms, ALP command bytes) tuples packed in the blob """
+    modem_uid, frames, _ = decode_frames_from(blob, 0, dictionary)
+    return modem_uid, frames
+
+
+def decode_frames_from(blob, offset, dictionary=None):
+    """ decodes the blob starting at offset, also returns the offset of the next blob """
+    if len(blob) - offset < HEADER.size:
+        raise ValueError("blob too short")
+
+    magic, version, flags, used_dictionary_id, length = HEADER.unpack_from(blob, offset)
+    if magic != MAGIC:
+        raise ValueError("not an ALP frame blob")
+    if version != VERSION:
+        raise ValueError("unsupported blob version {}".format(version))
+    if flags & FLAG_DICTIONARY and dictionary and dictionary_id(dictionary) != used_dictionary_id:
+        raise ValueError("blob was compressed with dictionary {:08x}, not {:08x}".format(used_dictionary_id, dictionary_id(dictionary)))
+
+    start = offset + HEADER.size
+    end = start + length
+    if end > len(blob):
+        raise ValueError("blob truncated")
+
+    body = bytearray(_decompress(bytes(blob[start:end]), flags, dictionary))
+    uid_length = body[0]
+    modem_uid = bytes(body[1:1 + uid_length]).decode("utf-8")
+    pos = 1 + uid_length
+    timestamp = TIMESTAMP.unpack_from(bytes(body[pos:pos + TIMESTAMP.size]))[0]
+    pos += TIMESTAMP.size
+    count, pos = _read_varint(body, pos)
+    frames = []
+    for _ in range(count):
+        delta, pos = _read_varint(body, pos)
+        timestamp += _unzigzag(delta)
+        size, pos = _read_varint(body, pos)
+        frames.append((timestamp, bytes(body[pos:pos + size])))
+        pos += size
+
+    return modem_uid, frames, end
+
+
+def train_dictionary(samples, size=4096):
+    """
+    builds a preset dictionary from recorded ALP commands. With zstandard the zstd trainer is used, otherwise the most
+    common commands are concatenated, with the most common ones last since zlib prefers matches close to the data.
+    """
+    samples = [bytes(sample) for sample in samples]
+    zstandard = _zstandard()
+    if zstandard is not None and len(samples) >= 8:
+        try:
+            return zstandard.train_dictionary(size, samples).as_bytes()
+        except Exception as e:
+            logger.warning("Training zstd dictionary failed, falling back to concatenating samples: {}".format(e))
+
+    counts = {}
+    for sample in samples:
+        counts[sample] = counts.get(sample, 0) + 1
+
+    dictionary = b""
+    for sample in sorted(counts.keys(), key=lambda sample: counts[sample]):
+        dictionary += sample
+
+    return dictionary[-size:]
+
+
+def load_dictionary(path):
+    with open(path, "rb") as f:
+        return f.read()
+
+
+class FrameBatcher:
+    """
+    Collects raw ALP commands per modem and publishes them as one blob using publish_callback(modem_uid, blob).
+    A batch is published interval_seconds after its first frame was added, or as soon as it reaches max_frames.
+    """
+    def __init__(self, publish_callback, interval_seconds=10, max_frames=100, compression=COMPRESSION_ZLIB, dictionary=None,
+                 scheduler=None):
+        if scheduler is None:
+            # imported here, the backend uses this module to decode blobs without the gateway modules
+            from scheduler import shared_scheduler
+            scheduler = shared_scheduler()
+
+        self.publish_callback = publish_callback
+        self.scheduler = scheduler
+        self.interval = interval_seconds
+        self.max_frames = max_frames
+        self.compression = compression
+        self.dictionary = dictionary
+        self.batches = {}  # modem UID -> list of (timestamp, data)
+        self.timer = None
+        self.lock = Lock()
+        self.frames = 0
+        self.blobs = 0
+        self.raw_bytes = 0
+        self.encoded_bytes = 0
+
+    def add(self, modem_uid, timestamp, data):
+        flush = []
+        with self.lock:
+            batch = self.batches.setdefault(modem_uid, [])
+            batch.append((timestamp, bytes(data)))
+            self.frames += 1
+            self.raw_bytes += len(data)
+            if len(batch) >= self.max_frames:
+                flush.append((modem_uid, self.batches.pop(modem_uid)))
+            elif self.timer is None:
+                self.timer = self.scheduler.call_later(self.interval, self.flush, "binary-uplink")
+
+        for modem_uid, frames in flush:
+            self.publish(modem_uid, frames)
+
+    def flush(self):
+        with self.lock:
+            batches = self.batches
+            self.batches = {}
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+
+        for modem_uid, frames in batches.items():
+            self.publish(modem_uid, frames)
+
+    def publish(self, modem_uid, frames):
+        blob = encode_frames(modem_uid, frames, self.compression, self.dictionary)
+        self.blobs += 1
+        self.encoded_bytes += len(blob)
+        logger.debug("Publishing {} frames of modem {} in {} bytes".format(len(frames), modem_uid, len(blob)))
+        self.publish_callback(modem_uid, blob)
+
+    def stats(self):
+        return {
+            'frames': self.frames,
+            'blobs': self.blobs,
+            'raw_bytes': self.raw_bytes,
+            'encoded_bytes': self.encoded_bytes
+        }
+
+
+def main():
+    argparser = argparse.ArgumentParser(description="Decode binary uplink blobs or train a dictionary for them")
+    subparsers = argparser.add_subparsers(dest="command")
+    train = subparsers.add_parser("train", help="train a dictionary from a file with one hex encoded ALP command per line")
+    train.add_argument("input")
+    train.add_argument("output")
+    train.add_argument("-s", "--size", help="dictionary size in bytes", type=int, default=4096)
+    decode = subparsers.add_parser("decode", help="print the frames in a file with one or more blobs")
+    decode.add_argument("input")
+    decode.add_argument("-d", "--dictionary", help="dictionary file used by the gateway")
+    config = argparser.parse_args()
+
+    if config.command == "train":
+        with open(config.input) as f:
+            samples = [bytearray.fromhex(line.strip()) for line in f if line.strip()]
+
+        dictionary = train_dictionary(samples, config.size)
+        with open(config.output, "wb") as f:
+            f.write(dictionary)
+
+        print("Trained dictionary {:08x} of {} bytes from {} frames".format(dictionary_id(dictionary), len(dictionary), len(samples)))
+    elif config.command == "decode":
+        dictionary = load_dictionary(config.dictionary) if config.dictionary else None
+        with open(config.input, "rb") as f:
+            blob = f.read()
+
+        offset = 0
+        while offset < len(blob):
+            modem_uid, frames, offset = decode_frames_from(blob, offset, dictionary)
+            for timestamp, data in frames:
+                print("{} {} {}".format(modem_uid, timestamp, binascii.hexlify(data).decode("ascii")))
+    else:
+        argparser.print_help()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,7 @@
+# Helpers for the values in pyd7a objects, without importing pyd7a, so the plug-in worker processes do not load it just
+# to read a file offset.
+
+
+def length_value(length):
+    # pyd7a wraps offsets and lengths in a Length object
+    return getattr(length, "value", length)
@@ -0,0 +1,74 @@
+import time
+from collections import OrderedDict
+from threading import Lock
+
+PRIMITIVE_TYPES = (str, int, float, bool, type(None))
+try:
+    PRIMITIVE_TYPES += (unicode, long)
+except NameError:
+    pass  # python 3
+
+
+class AttributeCache:
+    """
+    Remembers the last value published for each attribute key per device, so only changed attributes are sent.
+    The number of devices is bounded, the least recently updated device is evicted first. When max_age_seconds is set
+    an unchanged attribute is published again once its last publication is older than that. Only primitive values are
+    compared, other values (like the ALP command of a frame) differ on nearly every frame and are always published.
+    """
+    def __init__(self, max_devices=1000, max_age_seconds=0):
+        self.max_devices = max_devices
+        self.max_age = max_age_seconds
+        self.devices = OrderedDict()  # device -> key -> (value, time published)
+        self.lock = Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def changed(self, device, values):
+        """ returns the attributes in values which differ from the last published values, and records them """
+        now = time.time()
+        changed = {}
+        with self.lock:
+            attributes = self.devices.pop(device, None)
+            if attributes is None:
+                attributes = {}
+                if len(self.devices) >= self.max_devices:
+                    self.devices.popitem(last=False)
+
+            self.devices[device] = attributes  # move to the end, most recently used
+            for key, value in values.items():
+                if not isinstance(value, PRIMITIVE_TYPES):
+                    changed[key] = value
+                    continue
+
+                previous = attributes.get(key)
+                if previous is not None and previous[0] == value and \
+                        (self.max_age <= 0 or now - previous[1] < self.max_age):
+                    self.hits += 1
+                    continue
+
+                attributes[key] = (value, now)
+                changed[key] = value
+                self.misses += 1
+
+        return changed
+
+    def expire(self):
+        """ forgets attributes which would be published again anyway, so devices which stopped reporting free their memory """
+        if self.max_age <= 0:
+            return
+
+        now = time.time()
+        with self.lock:
+            for device, attributes in list(self.devices.items()):
+                for key, (value, published) in list(attributes.items()):
+                    if now - published >= self.max_age:
+                        del attributes[key]
+
+                if not attributes:
+                    del self.devices[device]
+
+    def clear(self):
+        with self.lock:
+            self.devices.clear()
+
@@ -0,0 +1,367 @@
+#!/usr/bin/env python
+"""
+Replays a stream of ALP commands through the gateway and measures how fast it is processed.
+
+The serial modem is replaced by a fake modem which delivers the commands, and paho is replaced by an in-process broker
+stand-in which acknowledges all publishes, so the numbers only reflect the processing inside the gateway. For every
+scenario the throughput, the end-to-end latency (from the modem callback until the frame is published) and the CPU time
+spent in each pipeline stage are reported and written as JSON to the output file, so results can be compared between
+commits.
+
+Run from the root of the repository:
+
+  $ PYTHONPATH="lib/pyd7a" python benchmarks/replay_benchmark.py --frames 5000 --output bench_results.json
+
+Commands are generated synthetically, or read from a file with one hex encoded ALP command per line (--input).
+"""
+
+import argparse
+import json
+import logging
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from threading import Condition, Lock
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import paho.mqtt.client as mqtt
+from bitstring import ConstBitStream
+
+from d7a.alp.command import Command
+from d7a.alp.operands.file import Data, Offset
+from d7a.alp.operands.interface_status import InterfaceStatusOperand
+from d7a.alp.operations.responses import ReturnFileData
+from d7a.alp.operations.status import InterfaceStatus
+from d7a.alp.parser import Parser
+from d7a.alp.regular_action import RegularAction
+from d7a.alp.status_action import StatusAction, StatusActionOperandExtensions
+from d7a.d7anp.addressee import Addressee, IdType
+from d7a.phy.channel_header import ChannelHeader, ChannelBand, ChannelClass, ChannelCoding
+from d7a.sp.status import Status
+from d7a.types.ct import CT
+
+import gateway
+import modems
+
+thread_time = getattr(time, "thread_time", time.time)
+
+SCENARIOS = {
+    "plain": [],
+    "save-bandwidth": ["--save-bandwidth"],
+    "binary-uplink": ["--save-bandwidth", "--binary-uplink-interval", "1"],
+    "plugins": ["--plugin-path", "parser-example"],
+    "plugins-process": ["--plugin-path", "parser-example", "--plugin-execution", "process"],
+    "batched": ["--batch-interval", "1"],
+    "aggregated": ["--aggregation-config", "etc/aggregation.json"],
+    "archived": ["--archive-dir", "{work_dir}/archive"],
+    "reconnecting": []
+}
+
+
+class FakeBroker:
+    """ stand-in for the MQTT brokers, can be taken down to simulate an outage """
+    def __init__(self):
+        self.up = True
+        self.clients = []
+        self.published = 0
+        self.published_bytes = 0
+        self.lock = Lock()
+
+    def set_up(self, up):
+        self.up = up
+        for client in self.clients:
+            client.wake()
+
+    def record(self, payload):
+        with self.lock:
+            self.published += 1
+            self.published_bytes += len(payload)
+
+
+broker = FakeBroker()
+
+
+class FakeMessageInfo:
+    def __init__(self, rc, mid):
+        self.rc = rc
+        self.mid = mid
+
+
+class FakeClient:
+    """ replaces paho.mqtt.client.Client, acknowledges every publish from the network loop """
+    def __init__(self, *args, **kwargs):
+        self.on_connect = None
+        self.on_disconnect = None
+        self.on_publish = None
+        self.on_message = None
+        self.connected = False
+        self.connack_pending = False
+        self.acks = []
+        self.mid = 0
+        self.condition = Condition()
+        broker.clients.append(self)
+
+    def username_pw_set(self, username, password=None):
+        pass
+
+    def max_inflight_messages_set(self, inflight):
+        pass
+
+    def connect(self, host, port=1883, keepalive=60):
+        if not broker.up:
+            raise socket.error("broker down")
+
+        self.connack_pending = True
+
+    def subscribe(self, topic, qos=0):
+        return mqtt.MQTT_ERR_SUCCESS, 0
+
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        with self.condition:
+            if not self.connected and qos == 0:
+                return FakeMessageInfo(mqtt.MQTT_ERR_NO_CONN, 0)
+
+            # like paho, QoS 1 messages published while disconnected are kept and sent after reconnecting
+            self.mid += 1
+            broker.record(payload or b"")
+            self.acks.append((self.mid, qos))
+            self.condition.notify()
+            return FakeMessageInfo(mqtt.MQTT_ERR_SUCCESS if self.connected else mqtt.MQTT_ERR_NO_CONN, self.mid)
+
+    def wake(self):
+        with self.condition:
+            self.condition.notify()
+
+    def loop(self, timeout=1.0):
+        with self.condition:
+            if not self.acks and not self.connack_pending and broker.up:
+                self.condition.wait(timeout)
+
+            acks = self.acks
+            self.acks = []
+
+        if not broker.up:
+            with self.condition:
+                # unacknowledged QoS 1 messages are resent and acknowledged after reconnecting, QoS 0 messages are lost
+                self.acks = [ack for ack in acks if ack[1] > 0] + self.acks
+
+            if self.connected:
+                self.connected = False
+                if self.on_disconnect is not None:
+                    self.on_disconnect(self, None, mqtt.MQTT_ERR_CONN_LOST)
+            return mqtt.MQTT_ERR_CONN_LOST
+
+        if self.connack_pending:
+            self.connack_pending = False
+            self.connected = True
+            if self.on_connect is not None:
+                self.on_connect(self, None, {}, 0)
+
+        if self.on_publish is not None:
+            for mid, qos in acks:
+                self.on_publish(self, None, mid)
+
+        return mqtt.MQTT_ERR_SUCCESS
+
+    def disconnect(self):
+        self.connected = False
+        if self.on_disconnect is not None:
+            self.on_disconnect(self, None, mqtt.MQTT_ERR_SUCCESS)
+
+
+class FakeModem:
+    """ replaces modem.modem.Modem, the benchmark delivers commands through receive_callback """
+    def __init__(self, device, rate, receive_callback, binary=False):
+        self.uid = "b0000000000000{:02x}".format(len(device))
+        self.receive_callback = receive_callback
+
+    def connect(self):
+        return True
+
+    def execute_command(self, cmd, timeout_seconds=1):
+        return []
+
+    def execute_command_async(self, cmd):
+        pass
+
+
+def synthetic_commands(count, nodes):
+    commands = []
+    for i in range(count):
+        status = Status(
+            channel_header=ChannelHeader(ChannelCoding.PN9, ChannelClass.NORMAL_RATE, ChannelBand.BAND_868),
+            channel_index=0, rx_level=70 + i % 20, link_budget=30 + i % 20, target_rx_level=80,
+            nls=False, missed=False, retry=False, unicast=False, fifo_token=i % 256, seq_nr=(i // 256) % 256,
+            response_to=CT(), addressee=Addressee(access_class=0x01, id_type=IdType.UID, id=0x4237343400240000 + i % nodes)
+        )
+        commands.append(Command(actions=[
+            StatusAction(status_operand_extension=StatusActionOperandExtensions.INTERFACE_STATUS,
+                         operation=InterfaceStatus(operand=InterfaceStatusOperand(interface_id=0xd7, interface_status=status))),
+            RegularAction(operation=ReturnFileData(operand=Data(offset=Offset(id=64), data=[i % 256, (i * 7) % 256])))
+        ], generate_tag_request_action=False))
+
+    return commands
+
+
+def recorded_commands(path):
+    commands = []
+    with open(path) as f:
+        for line in f:
+            data = bytearray.fromhex(line.strip())
+            if data:
+                commands.append(Parser().parse(ConstBitStream(bytes=data), len(data)))
+
+    return commands
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(fraction * (len(values) - 1))))]
+
+
+def wait_idle(gw, count):
+    first = gw.pipeline.stages[0]
+    while first.processed + first.dropped < count:
+        time.sleep(0.01)
+
+    # the downstream stages and the sinks are idle when their counters stop changing and their queues are empty
+    previous = None
+    while True:
+        current = [(stage.queue.qsize(), stage.processed) for stage in gw.pipeline.stages + gw.sinks.stages]
+        if current == previous and all(depth == 0 for depth, processed in current):
+            return
+
+        previous = current
+        time.sleep(0.05)
+
+
+def run_scenario(name, commands, rate, work_dir):
+    broker.set_up(True)
+    args = ["--enable-thingsboard", "1", "--token", "benchmark", "--skip-system-files", "--device", "bench0",
+            "--logfile", os.devnull, "--queue-file", os.path.join(work_dir, "{}-queue.db".format(name))] + \
+        [arg.format(work_dir=work_dir) for arg in SCENARIOS[name]]
+    gw = gateway.Gateway(args)
+    logging.getLogger().setLevel(logging.WARNING)
+
+    # measure the latency from the modem callback until the frame is published by the MQTT sink, and the CPU time of
+    # each stage and sink
+    received = {}
+    latencies = []
+    lock = Lock()
+    mqtt_stage = gw.sinks.stages[[sink.name for sink in gw.sinks.sinks].index("mqtt")]
+    deliver = mqtt_stage.handler
+
+    def timed_deliver(frame):
+        deliver(frame)
+        start = received.pop(id(frame.cmd), None)
+        if start is not None:
+            with lock:
+                latencies.append(time.time() - start)
+
+    stage_cpu = {}
+    for stage in gw.pipeline.stages + gw.sinks.stages:
+        stage_cpu[stage.name] = 0.0
+        handler = timed_deliver if stage is mqtt_stage else stage.handler
+
+        def timed(item, handler=handler, name=stage.name):
+            start = thread_time()
+            try:
+                return handler(item)
+            finally:
+                stage_cpu[name] += thread_time() - start
+
+        stage.handler = timed
+
+    modem = gw.modems[0]
+    modem.connected.wait(10)
+    for client in broker.clients:
+        while not client.connected:
+            time.sleep(0.01)
+
+    if name in ("save-bandwidth", "binary-uplink"):
+        commands = [bytes(bytearray(cmd)) for cmd in commands]
+
+    start = time.time()
+    for i, cmd in enumerate(commands):
+        if name == "reconnecting" and i % max(1, len(commands) // 4) == 0 and i > 0:
+            broker.set_up(not broker.up)
+
+        received[id(cmd)] = time.time()
+        modem.on_command_received(cmd)
+        if rate > 0:
+            delay = start + float(i + 1) / rate - time.time()
+            if delay > 0:
+                time.sleep(delay)
+
+    broker.set_up(True)
+    wait_idle(gw, len(commands))
+    duration = time.time() - start
+
+    gw.stop()
+    for handler in logging.getLogger().handlers[:]:
+        logging.getLogger().removeHandler(handler)
+    del broker.clients[:]
+
+    return {
+        "scenario": name,
+        "frames": len(commands),
+        "published_frames": len(latencies),
+        "duration_s": duration,
+        "throughput_fps": len(commands) / duration if duration > 0 else None,
+        "latency_p50_ms": percentile(latencies, 0.5) * 1000 if latencies else None,
+        "latency_p99_ms": percentile(latencies, 0.99) * 1000 if latencies else None,
+        "stage_cpu_s": stage_cpu,
+        "pipeline": gw.pipeline.stats(),
+        "sinks": gw.sinks.stats(),
+        "mqtt_messages": broker.published,
+        "mqtt_bytes": broker.published_bytes
+    }
+
+
+def main():
+    argparser = argparse.ArgumentParser(description="Replay ALP commands through the gateway and measure throughput and latency")
+    argparser.add_argument("-s", "--scenario", help="scenario to run, can be repeated (default: all)", action="append",
+                           choices=sorted(SCENARIOS.keys()), default=[])
+    argparser.add_argument("-i", "--input", help="file with one hex encoded ALP command per line, instead of synthetic commands")
+    argparser.add_argument("-f", "--frames", help="number of synthetic commands", type=int, default=2000)
+    argparser.add_argument("-n", "--nodes", help="number of different nodes in the synthetic commands", type=int, default=100)
+    argparser.add_argument("-r", "--rate", help="replay rate in frames/s (0 replays as fast as possible)", type=float, default=0)
+    argparser.add_argument("-o", "--output", help="JSON file to write the results to", default="bench_results.json")
+    config = argparser.parse_args()
+
+    mqtt.Client = FakeClient
+    modems.Modem = FakeModem
+
+    if config.input:
+        commands = recorded_commands(config.input)
+    else:
+        commands = synthetic_commands(config.frames, config.nodes)
+
+    work_dir = tempfile.mkdtemp(prefix="gateway-benchmark-")
+    results = []
+    try:
+        for name in config.scenario or sorted(SCENARIOS.keys()):
+            broker.published = 0
+            broker.published_bytes = 0
+            result = run_scenario(name, commands, config.rate, work_dir)
+            results.append(result)
+            print("{scenario:15} {throughput_fps:10.1f} frames/s  p50 {latency_p50_ms} ms  p99 {latency_p99_ms} ms  "
+                  "{mqtt_messages} MQTT messages".format(**result))
+    finally:
+        shutil.rmtree(work_dir)
+
+    git_rev = subprocess.check_output(["git", "describe", "--always", "--dirty"]).strip().decode("utf-8")
+    with open(config.output, "w") as f:
+        json.dump({"git_rev": git_rev, "time": time.time(), "rate": config.rate, "results": results}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,5 @@
+from enum import Enum
+
+class DataPointType(Enum):
+  attribute = 0
+  telemetry = 1
@@ -0,0 +1,55 @@
+import time
+from threading import Lock
+
+
+class DuplicateFilter:
+    """
+    Detects frames received more than once within a time window, for example retransmissions by the node.
+    Keys are stored in a ring buffer of fixed capacity, when it is full the oldest key is overwritten, so memory use
+    does not depend on the traffic. For every key the timestamp and the best link budget of the copies is kept.
+    """
+    def __init__(self, window_seconds=2, capacity=1024):
+        self.window = window_seconds
+        self.capacity = capacity
+        self.ring = [None] * capacity
+        self.position = 0
+        self.entries = {}  # key -> [time received, timestamp of first copy, best link budget]
+        self.lock = Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def check(self, key, timestamp, link_budget):
+        """
+        returns None when this is the first copy of the frame, otherwise a (timestamp, improved) tuple with the timestamp
+        of the first copy and whether this copy has a better link budget than the previous ones
+        """
+        now = time.time()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and now - entry[0] <= self.window:
+                self.hits += 1
+                improved = link_budget > entry[2]
+                if improved:
+                    entry[2] = link_budget
+
+                return entry[1], improved
+
+            self.misses += 1
+            if entry is None:
+                evicted = self.ring[self.position]
+                if evicted is not None:
+                    del self.entries[evicted]
+
+                self.ring[self.position] = key
+                self.position = (self.position + 1) % self.capacity
+
+            self.entries[key] = [now, timestamp, link_budget]
+            return None
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': float(self.hits) / total if total > 0 else 0.0
+        }
@@ -0,0 +1,298 @@
+import heapq
+import itertools
+import logging
+import time
+from threading import Condition, Thread
+
+from d7a.alp.operations.forward import Forward
+from d7a.alp.operations.write_operations import WriteFileData
+
+from alp_util import length_value
+
+logger = logging.getLogger(__name__)
+
+PRIORITY_HIGH = 0
+PRIORITY_NORMAL = 1
+PRIORITY_LOW = 2
+PRIORITIES = {"high": PRIORITY_HIGH, "normal": PRIORITY_NORMAL, "low": PRIORITY_LOW}
+
+# DASH7 normal rate channel
+DEFAULT_BITRATE = 55555
+# preamble, sync word, length and CRC, rounded up
+FRAME_OVERHEAD_SECONDS = 0.002
+
+
+def _forward_target(operand):
+    # the interface and the addressee the following actions are forwarded to
+    addressee = getattr(operand.interface_configuration, "addressee", None)
+    if addressee is None:
+        return operand.interface_id, None
+
+    return operand.interface_id, (addressee.access_class, addressee.id_type, addressee.id)
+
+
+def coalesce_key(cmd):
+    """
+    returns the destinations and the files and offsets written by a command which only writes files (forward actions,
+    as added by Command.create_with_write_file_action, select the destination), so a later command writing the same
+    data to the same destination can replace it while it is still queued, or None when the command also does something else
+    """
+    targets = []
+    writes = []
+    for action in getattr(cmd, "actions", []):
+        if type(action.operation) is Forward:
+            targets.append(_forward_target(action.operation.operand))
+        elif type(action.operation) is WriteFileData:
+            writes.append((action.operand.offset.id, length_value(action.operand.offset.offset)))
+        else:
+            return None
+
+    return (tuple(targets), tuple(sorted(writes))) if writes else None
+
+
+def command_size(cmd):
+    try:
+        return len(bytearray(cmd))
+    except Exception:
+        return 32  # typical size of a write file command, used when the command cannot be serialized
+
+
+class AirtimeBudget:
+    """ token bucket of transmit time, refilled at duty_cycle seconds per second up to burst_seconds """
+    def __init__(self, duty_cycle, burst_seconds):
+        self.rate = duty_cycle
+        self.capacity = burst_seconds
+        self.tokens = burst_seconds
+        self.updated = time.time()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, airtime, now):
+        """ returns the number of seconds until the airtime is available, a transmission longer than the burst needs a full bucket """
+        self._refill(now)
+        needed = min(airtime, self.capacity)
+        if self.tokens >= needed:
+            return 0
+
+        return (needed - self.tokens) / self.rate
+
+    def consume(self, airtime, now):
+        self._refill(now)
+        self.tokens -= airtime
+
+
+class Downlink:
+    def __init__(self, device, request_id, command, priority, key, airtime):
+        self.device = device
+        self.request_id = request_id
+        self.command = command
+        self.priority = priority
+        self.key = key
+        self.airtime = airtime
+        self.queued_at = time.time()
+        self.sent_at = None
+        self.tag_id = None
+
+
+class DownlinkScheduler:
+    """
+    Queues commands received through RPC and transmits them on a thread of its own, so the MQTT network thread is never
+    blocked by the modem. Commands are sent in order of priority, at most one at a time per device: the next command for
+    a device is only sent when the previous one completed or timed out. A queued command which only writes files is
+    replaced by a later command writing the same files, the superseded request is answered right away. The airtime
+    used is limited to a duty cycle by a token bucket. Completed commands are matched to their request by the tag ID of
+    the response, and answered using response_callback(device, request_id, data).
+    """
+    def __init__(self, send_callback, response_callback, duty_cycle=0.01, burst_seconds=0.1, bitrate=DEFAULT_BITRATE,
+                 response_timeout_seconds=30):
+        self.send_callback = send_callback
+        self.response_callback = response_callback
+        self.budget = AirtimeBudget(duty_cycle, burst_seconds)
+        self.bitrate = bitrate
+        self.response_timeout = response_timeout_seconds
+        self.heap = []  # (priority, sequence number, downlink)
+        self.sequence = itertools.count()
+        self.queued = {}  # (device, coalesce key) -> queued downlink which can be replaced
+        self.busy = {}  # device -> downlink sent and awaiting its response
+        self.pending = {}  # tag ID -> downlink sent and awaiting its response
+        self.condition = Condition()
+        self.stopped = False
+        self.thread = None
+        self.sent = 0
+        self.coalesced = 0
+        self.timeouts = 0
+        self.latency = None
+
+    def instrument(self, metrics):
+        self.latency = metrics.histogram("downlink_seconds", "Time from receiving an RPC until the modem completed the command")
+        metrics.gauge("downlink_queued", "RPC commands waiting to be sent", lambda: len(self.heap))
+        metrics.counter("downlink_sent_total", "RPC commands sent", lambda: self.sent)
+        metrics.counter("downlink_coalesced_total", "RPC commands replaced by a later command", lambda: self.coalesced)
+        metrics.counter("downlink_timeouts_total", "RPC commands without response", lambda: self.timeouts)
+
+    def airtime(self, cmd):
+        return FRAME_OVERHEAD_SECONDS + command_size(cmd) * 8.0 / self.bitrate
+
+    def start(self):
+        self.thread = Thread(target=self.run, name="downlink")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        with self.condition:
+            self.stopped = True
+            self.condition.notify()
+
+        if self.thread is not None:
+            self.thread.join()
+
+    def submit(self, device, request_id, command, priority=PRIORITY_NORMAL, key=None, airtime=None):
+        """ queues a command, the airtime is estimated from its size unless given (commands for the modem itself use none) """
+        airtime = self.airtime(command) if airtime is None else airtime
+        superseded = None
+        with self.condition:
+            downlink = self.queued.get((device, key)) if key is not None else None
+            if downlink is not None:
+                superseded = downlink.request_id
+                downlink.request_id = request_id
+                downlink.command = command
+                downlink.airtime = airtime
+                self.coalesced += 1
+                if priority < downlink.priority:
+                    # the entry with the old priority is skipped when it is popped
+                    downlink.priority = priority
+                    heapq.heappush(self.heap, (priority, next(self.sequence), downlink))
+            else:
+                downlink = Downlink(device, request_id, command, priority, key, airtime)
+                heapq.heappush(self.heap, (priority, next(self.sequence), downlink))
+                if key is not None:
+                    self.queued[(device, key)] = downlink
+
+            self.condition.notify()
+
+        if superseded is not None:
+            logger.info("RPC request {} for {} superseded by request {}".format(superseded, device, request_id))
+            self.respond(device, superseded, {"status": "superseded", "by": request_id})
+
+    def on_command_received(self, cmd):
+        """ called for every command received from a modem, completes the downlink with the same tag ID """
+        tag_id = getattr(cmd, "tag_id", None)
+        if tag_id is None or not getattr(cmd, "execution_completed", False):
+            return
+
+        with self.condition:
+            downlink = self.pending.pop(tag_id, None)
+            if downlink is None:
+                return
+
+            self.busy.pop(downlink.device, None)
+            self.condition.notify()
+
+        latency = time.time() - downlink.queued_at
+        if self.latency is not None:
+            self.latency.observe(latency)
+
+        status = "error" if getattr(cmd, "completed_with_error", False) else "ok"
+        logger.info("RPC request {} for {} completed ({}) in {:.3f} s".format(downlink.request_id, downlink.device, status, latency))
+        self.respond(downlink.device, downlink.request_id, {"status": status, "latency_ms": int(latency * 1000), "response": cmd})
+
+    def respond(self, device, request_id, data):
+        try:
+            self.response_callback(device, request_id, data)
+        except Exception:
+            logger.exception("Could not send response to RPC request {}".format(request_id))
+
+    def next_downlink(self, now):
+        """ returns the downlink to send now, or None and the number of seconds to wait for the airtime budget """
+        skipped = []
+        try:
+            while self.heap:
+                priority, sequence, downlink = heapq.heappop(self.heap)
+                if downlink.sent_at is not None or priority != downlink.priority:
+                    continue  # replaced by an entry with a higher priority
+
+                if downlink.device in self.busy:
+                    skipped.append((priority, sequence, downlink))
+                    continue
+
+                wait = self.budget.wait_time(downlink.airtime, now)
+                if wait > 0:
+                    skipped.append((priority, sequence, downlink))
+                    return None, wait
+
+                return downlink, 0
+
+            return None, None
+        finally:
+            for entry in skipped:
+                heapq.heappush(self.heap, entry)
+
+    def expire(self, now):
+        expired = []
+        for tag_id, downlink in list(self.pending.items()):
+            if now - downlink.sent_at > self.response_timeout:
+                del self.pending[tag_id]
+                self.busy.pop(downlink.device, None)
+                expired.append(downlink)
+
+        self.timeouts += len(expired)
+        return expired
+
+    def run(self):
+        while True:
+            with self.condition:
+                if self.stopped:
+                    return
+
+                now = time.time()
+                expired = self.expire(now)
+                downlink = None
+                if not expired:
+                    downlink, wait = self.next_downlink(now)
+                    if downlink is None:
+                        if self.pending:
+                            expiry = min(pending.sent_at for pending in self.pending.values()) + self.response_timeout - now
+                            wait = expiry if wait is None else min(wait, expiry)
+
+                        self.condition.wait(wait)
+                        continue
+
+                    downlink.sent_at = now
+                    downlink.tag_id = getattr(downlink.command, "tag_id", None)
+                    self.queued.pop((downlink.device, downlink.key), None)
+                    self.budget.consume(downlink.airtime, now)
+                    self.busy[downlink.device] = downlink
+                    if downlink.tag_id is not None:
+                        self.pending[downlink.tag_id] = downlink
+
+            for timed_out in expired:
+                logger.warning("No response to RPC request {} for {}".format(timed_out.request_id, timed_out.device))
+                self.respond(timed_out.device, timed_out.request_id, {"status": "timeout"})
+
+            if downlink is not None:
+                self.send(downlink)
+
+    def send(self, downlink):
+        self.sent += 1
+        try:
+            self.send_callback(downlink)
+        except Exception as e:
+            logger.exception("Could not send RPC request {} to {}".format(downlink.request_id, downlink.device))
+            self.release(downlink)
+            self.respond(downlink.device, downlink.request_id, {"status": "error", "error": str(e)})
+            return
+
+        if downlink.tag_id is None:
+            # the response cannot be matched without tag, answer when the command is sent
+            self.release(downlink)
+            self.respond(downlink.device, downlink.request_id, {"status": "sent"})
+
+    def release(self, downlink):
+        with self.condition:
+            self.busy.pop(downlink.device, None)
+            if downlink.tag_id is not None:
+                self.pending.pop(downlink.tag_id, None)
+
+            self.condition.notify()
@@ -0,0 +1,143 @@
+import glob
+import json
+import logging
+import os
+import struct
+
+from datapoint import DataPointType
+from alp_util import length_value
+
+try:
+    import yaml
+except ImportError:
+    yaml = None
+
+logger = logging.getLogger(__name__)
+
+# Declarative file parsers, as an alternative to writing a plugin. A parser definition maps a file ID to a list of
+# fields, for example:
+#
+# {
+#   "name": "sensor file",
+#   "file_id": 64,
+#   "endianness": "big",
+#   "fields": [
+#     {"name": "temperature", "offset": 0, "type": "int16", "scale": 0.1, "datapoint": "telemetry"}
+#   ]
+# }
+#
+# Definitions are read from *.parser.json (or *.parser.yaml when PyYAML is installed) files in the plugin path. A file
+# can contain one definition or a list of definitions. At load time the fields are compiled into a single struct
+# format, so decoding a file is one unpack call.
+
+TYPES = {
+    "int8": "b",
+    "uint8": "B",
+    "int16": "h",
+    "uint16": "H",
+    "int32": "i",
+    "uint32": "I",
+    "int64": "q",
+    "uint64": "Q",
+    "float": "f",
+    "double": "d"
+}
+
+BYTE_ORDERS = {
+    "big": ">",
+    "little": "<"
+}
+
+
+class Field:
+    def __init__(self, definition, byte_order):
+        self.name = definition["name"]
+        self.offset = int(definition["offset"])
+        if definition["type"] not in TYPES:
+            raise ValueError("field {}: unknown type {}".format(self.name, definition["type"]))
+
+        self.format = TYPES[definition["type"]]
+        self.struct = struct.Struct(byte_order + self.format)
+        self.size = self.struct.size
+        self.scale = definition.get("scale", None)
+        self.datapoint_type = DataPointType[definition.get("datapoint", "telemetry")]
+
+
+class FileParser:
+    """ parses the data of one file according to a declarative definition, using the same interface as the plugins """
+    def __init__(self, definition):
+        self.name = definition.get("name", "file {}".format(definition["file_id"]))
+        self.file_id = int(definition["file_id"])
+        byte_order = BYTE_ORDERS[definition.get("endianness", "big")]
+        self.fields = sorted((Field(field, byte_order) for field in definition["fields"]), key=lambda field: field.offset)
+        if not self.fields:
+            raise ValueError("parser {} has no fields".format(self.name))
+
+        # compile all fields into one struct, with pad bytes for the gaps between fields
+        format = byte_order
+        position = self.fields[0].offset
+        for field in self.fields:
+            if field.offset < position:
+                raise ValueError("parser {}: field {} overlaps the previous field".format(self.name, field.name))
+
+            format += "{}x".format(field.offset - position) if field.offset > position else ""
+            format += field.format
+            position = field.offset + field.size
+
+        self.struct = struct.Struct(format)
+        self.start = self.fields[0].offset
+        self.end = self.start + self.struct.size
+        self.file_ids = {self.file_id: (self.start, self.struct.size)}
+
+    def parse_file_data(self, file_offset, length, data):
+        data = bytearray(data)
+        data_start = length_value(file_offset.offset)
+        data_end = data_start + len(data)
+        if data_start <= self.start and self.end <= data_end:
+            values = self.struct.unpack_from(data, self.start - data_start)
+            for field, value in zip(self.fields, values):
+                yield self._datapoint(field, value)
+        else:
+            # partial update of the file, only parse the fields which are completely present
+            for field in self.fields:
+                if data_start <= field.offset and field.offset + field.size <= data_end:
+                    yield self._datapoint(field, field.struct.unpack_from(data, field.offset - data_start)[0])
+
+    def _datapoint(self, field, value):
+        if field.scale is not None:
+            value = value * field.scale
+
+        return field.name, value, field.datapoint_type
+
+
+def _read_definitions(path):
+    with open(path) as f:
+        if path.endswith(".json"):
+            definitions = json.load(f)
+        else:
+            definitions = yaml.safe_load(f)
+
+    if isinstance(definitions, dict):
+        definitions = [definitions]
+
+    return definitions
+
+
+def load_parsers(path):
+    """ returns the FileParsers for all parser definitions found in path """
+    files = sorted(glob.glob(os.path.join(path, "*.parser.json")))
+    yaml_files = sorted(glob.glob(os.path.join(path, "*.parser.yaml")) + glob.glob(os.path.join(path, "*.parser.yml")))
+    if yaml is not None:
+        files += yaml_files
+    elif yaml_files:
+        logger.warning("PyYAML is not installed, skipping parser definitions {}".format(", ".join(yaml_files)))
+
+    parsers = []
+    for file in files:
+        try:
+            for definition in _read_definitions(file):
+                parsers.append(FileParser(definition))
+        except Exception as e:
+            logger.error("Could not load parser definitions from {}: {}".format(file, e))
+
+    return parsers
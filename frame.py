@@ -0,0 +1,20 @@
+class Frame:
+    """
+    A command received from the modem together with the data extracted from it while passing through the pipeline.
+    The sinks only use the collected attributes and telemetry, they do not need to know about the ALP command.
+    """
+    def __init__(self, cmd, timestamp, modem_uid, binary=False):
+        self.cmd = cmd
+        self.timestamp = timestamp  # ms since epoch
+        self.modem_uid = modem_uid
+        self.binary = binary  # cmd contains the raw ALP bytes (save bandwidth mode)
+        self.node_id = modem_uid  # overwritten with the remote node ID when received over the D7 interface
+        self.interface_status = None
+        self.duplicate = False  # only carries the better link budget of a frame which was already forwarded
+        self.replayed = False  # read back from the frame archive
+        self.gw_attributes = {}
+        self.device_attributes = {}
+        self.device_telemetry = {}
+
+    def raw(self):
+        return bytearray(self.cmd)
@@ -0,0 +1,281 @@
+#!/usr/bin/env python
+"""
+Local archive of the received frames, so they can be parsed again (with a new plugin for example) or uploaded again.
+
+Frames are appended to segment files named after the timestamp of their first frame. Every record is:
+
+  timestamp in ms (8 bytes) | modem UID length (1) | node ID length (1) | ALP length (2) | modem UID | node ID | ALP command
+
+all big endian. Records are grouped in blocks of block_size records; for every block the timestamp of its first frame,
+its offset, its length and the node IDs it contains are appended to the index file of the segment:
+
+  timestamp in ms (8) | offset (4) | length (4) | number of nodes (2) | per node: length (1) | node ID
+
+so a reader can skip to the first block of a time range and skip blocks without frames of the node it looks for.
+Readers only see complete blocks, records after the last indexed block (after a crash) are ignored.
+Segments are read using memory mapped I/O. When a segment exceeds segment_size bytes a new one is started, and the
+oldest segments are removed when the archive exceeds max_bytes or the segments are older than max_age_seconds.
+
+  $ python frame_archive.py /var/lib/d7-gateway/archive --from 2020-01-01T00:00 --node 4237343400240035
+"""
+
+import argparse
+import binascii
+import bisect
+import calendar
+import glob
+import logging
+import mmap
+import os
+import struct
+import time
+from threading import Lock
+
+logger = logging.getLogger(__name__)
+
+RECORD = struct.Struct(">QBBH")
+INDEX_ENTRY = struct.Struct(">QIIH")
+SEGMENT_SUFFIX = ".seg"
+INDEX_SUFFIX = ".idx"
+
+
+def _encode(text):
+    return text.encode("utf-8")[:255]
+
+
+class FrameArchive:
+    def __init__(self, path, segment_size=16 * 1024 * 1024, block_size=64, max_bytes=1024 * 1024 * 1024, max_age_seconds=0):
+        self.path = path
+        self.segment_size = segment_size
+        self.block_size = block_size
+        self.max_bytes = max_bytes
+        self.max_age = max_age_seconds
+        self.lock = Lock()
+        self.segment = None  # data file of the segment being written
+        self.index = None
+        self.segment_bytes = 0
+        self.block_records = 0
+        self.block_nodes = set()
+        self.block_start = None  # (timestamp, offset) of the block being written
+        self.appended = 0
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+        self.enforce_retention()
+
+    def segments(self):
+        """ returns the (start timestamp, data file) of the segments, oldest first """
+        segments = []
+        for file_name in glob.glob(os.path.join(self.path, "*" + SEGMENT_SUFFIX)):
+            try:
+                segments.append((int(os.path.basename(file_name)[:-len(SEGMENT_SUFFIX)]), file_name))
+            except ValueError:
+                continue
+
+        return sorted(segments)
+
+    def append(self, timestamp, modem_uid, node_id, data):
+        modem_uid = _encode(modem_uid)
+        node_id = _encode(node_id)
+        with self.lock:
+            if self.segment is None or self.segment_bytes >= self.segment_size:
+                self.rotate(timestamp)
+
+            if self.block_start is None:
+                self.block_start = (timestamp, self.segment_bytes)
+
+            record = RECORD.pack(timestamp, len(modem_uid), len(node_id), len(data)) + modem_uid + node_id + bytes(data)
+            self.segment.write(record)
+            self.segment_bytes += len(record)
+            self.block_nodes.add(node_id)
+            self.block_records += 1
+            self.appended += 1
+            if self.block_records >= self.block_size:
+                self.close_block()
+
+    def close_block(self):
+        if self.block_start is None:
+            return
+
+        timestamp, offset = self.block_start
+        entry = INDEX_ENTRY.pack(timestamp, offset, self.segment_bytes - offset, len(self.block_nodes))
+        for node_id in sorted(self.block_nodes):
+            entry += struct.pack(">B", len(node_id)) + node_id
+
+        self.segment.flush()
+        self.index.write(entry)
+        self.index.flush()
+        self.block_start = None
+        self.block_nodes = set()
+        self.block_records = 0
+
+    def rotate(self, timestamp):
+        self.close_segment()
+        base = os.path.join(self.path, "{:013d}".format(timestamp))
+        while os.path.exists(base + SEGMENT_SUFFIX):
+            timestamp += 1  # a segment starting at the same millisecond, keep the names unique and ordered
+            base = os.path.join(self.path, "{:013d}".format(timestamp))
+
+        self.segment = open(base + SEGMENT_SUFFIX, "ab")
+        self.index = open(base + INDEX_SUFFIX, "ab")
+        self.segment_bytes = 0
+        self._enforce_retention()
+
+    def close_segment(self):
+        if self.segment is not None:
+            self.close_block()
+            self.segment.close()
+            self.index.close()
+            self.segment = None
+            self.index = None
+
+    def flush(self):
+        with self.lock:
+            if self.segment is not None:
+                self.close_block()
+
+    def close(self):
+        with self.lock:
+            self.close_segment()
+
+    def enforce_retention(self):
+        """ removes the oldest segments, called periodically so segments expire while no new segment is started """
+        with self.lock:
+            self._enforce_retention()
+
+    def _enforce_retention(self):
+        segments = self.segments()
+        current = self.segment.name if self.segment is not None else None
+        sizes = dict((file_name, os.path.getsize(file_name)) for _, file_name in segments)
+        total = sum(sizes.values())
+        now_ms = int(time.time() * 1000)
+        for i, (start, file_name) in enumerate(segments):
+            if file_name == current:
+                break
+
+            # a segment ends where the next one starts
+            end = segments[i + 1][0] if i + 1 < len(segments) else now_ms
+            expired = self.max_age > 0 and now_ms - end > self.max_age * 1000
+            if not expired and (self.max_bytes <= 0 or total <= self.max_bytes):
+                break
+
+            logger.info("Removing archive segment {}".format(file_name))
+            os.remove(file_name)
+            index_name = file_name[:-len(SEGMENT_SUFFIX)] + INDEX_SUFFIX
+            if os.path.exists(index_name):
+                os.remove(index_name)
+            total -= sizes[file_name]
+
+    def read(self, start_ms=0, end_ms=None, node_id=None):
+        """ yields the (timestamp, modem UID, node ID, ALP command) of the archived frames in the time range """
+        self.flush()
+        segments = self.segments()
+        for i, (segment_start, file_name) in enumerate(segments):
+            if end_ms is not None and segment_start > end_ms:
+                break
+            if i + 1 < len(segments) and segments[i + 1][0] < start_ms:
+                continue
+
+            for frame in self.read_segment(file_name, start_ms, end_ms, node_id):
+                yield frame
+
+    def read_segment(self, file_name, start_ms, end_ms, node_id=None):
+        node = _encode(node_id) if node_id is not None else None
+        blocks = read_index(file_name[:-len(SEGMENT_SUFFIX)] + INDEX_SUFFIX)
+        if not blocks:
+            return
+
+        with open(file_name, "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            if size == 0:
+                return
+
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                # start at the last block which starts before the range, it can contain frames of the range
+                first = max(0, bisect.bisect_right([block[0] for block in blocks], start_ms) - 1)
+                for i in range(first, len(blocks)):
+                    block_start, offset, length, nodes = blocks[i]
+                    if end_ms is not None and block_start > end_ms:
+                        break
+                    if (node is not None and node not in nodes) or offset + length > size:
+                        continue
+
+                    for frame in read_records(data, offset, offset + length):
+                        if frame[0] < start_ms or (end_ms is not None and frame[0] > end_ms):
+                            continue
+                        if node is not None and frame[2] != node_id:
+                            continue
+
+                        yield frame
+            finally:
+                data.close()
+
+    def stats(self):
+        segments = self.segments()
+        return {
+            'segments': len(segments),
+            'bytes': sum(os.path.getsize(file_name) for _, file_name in segments),
+            'appended': self.appended
+        }
+
+
+def read_index(file_name):
+    """ returns a list of (timestamp, offset, length, set of node IDs) of the blocks in the index file """
+    try:
+        with open(file_name, "rb") as f:
+            data = f.read()
+    except (IOError, OSError):
+        return []
+
+    blocks = []
+    pos = 0
+    while pos + INDEX_ENTRY.size <= len(data):
+        timestamp, offset, length, count = INDEX_ENTRY.unpack_from(data, pos)
+        pos += INDEX_ENTRY.size
+        nodes = set()
+        for _ in range(count):
+            node_length = bytearray(data[pos:pos + 1] or b"\0")[0]
+            nodes.add(data[pos + 1:pos + 1 + node_length])
+            pos += 1 + node_length
+
+        if pos > len(data):
+            break  # the entry is still being written
+
+        blocks.append((timestamp, offset, length, nodes))
+
+    return blocks
+
+
+def read_records(data, offset, end):
+    while offset + RECORD.size <= end:
+        timestamp, modem_length, node_length, length = RECORD.unpack_from(data, offset)
+        pos = offset + RECORD.size
+        modem_uid = data[pos:pos + modem_length].decode("utf-8")
+        pos += modem_length
+        node_id = data[pos:pos + node_length].decode("utf-8")
+        pos += node_length
+        yield timestamp, modem_uid, node_id, data[pos:pos + length]
+        offset = pos + length
+
+
+def _parse_time(value):
+    return int(calendar.timegm(time.strptime(value, "%Y-%m-%dT%H:%M")) * 1000)
+
+
+def main():
+    argparser = argparse.ArgumentParser(description="Print the frames in the archive of the gateway as hex ALP commands")
+    argparser.add_argument("path", help="archive directory")
+    argparser.add_argument("-f", "--from", dest="start", help="start of the time range (UTC), as 2020-01-31T12:00")
+    argparser.add_argument("-t", "--to", dest="end", help="end of the time range (UTC), as 2020-01-31T13:00")
+    argparser.add_argument("-n", "--node", help="only frames of this node")
+    config = argparser.parse_args()
+
+    archive = FrameArchive(config.path, max_bytes=0)
+    for timestamp, modem_uid, node_id, data in archive.read(_parse_time(config.start) if config.start else 0,
+                                                            _parse_time(config.end) if config.end else None, config.node):
+        print("{} {} {} {}".format(timestamp, modem_uid, node_id, binascii.hexlify(data).decode("ascii")))
+
+
+if __name__ == "__main__":
+    main()
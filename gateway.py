@@ -1,21 +1,20 @@
 #!/usr/bin/env python
 
+import time
+
+STARTED = time.time()  # the time to the first forwarded frame is measured from here, including the imports below
+
 import argparse
-import platform
+import os
 import socket
 import subprocess
 import traceback
-from enum import Enum
-import jsonpickle
 import json
 import serial
-import time
-from datetime import datetime
-from threading import Timer
 import signal
+from datetime import datetime
+from threading import Event, Thread
 import sys
-import binascii
-from yapsy.PluginManager import PluginManagerSingleton
 
 from d7a.alp.command import Command
 from d7a.alp.interface import InterfaceType
@@ -26,29 +25,64 @@ from d7a.sp.qos import ResponseMode, QoS
 from d7a.system_files.dll_config import DllConfigFile
 from d7a.system_files.system_file_ids import SystemFileIds
 from d7a.system_files.system_files import SystemFiles
-from modem.modem import Modem
 
-from thingsboard import Thingsboard
-from mqtt_class import Mqtt
+from alp_framing import COMPRESSION_METHODS, COMPRESSION_ZLIB
+from downlink import DownlinkScheduler, PRIORITIES, PRIORITY_HIGH, PRIORITY_NORMAL, PRIORITY_LOW, coalesce_key
+from modems import GatewayModem
+from datapoint import DataPointType
+from frame import Frame
+from metrics import Registry
+from offline_queue import EVICTION_POLICIES, EVICT_DROP_OLDEST
+from plugin_executor import PluginExecutor, EXECUTION_MODES, EXECUTION_INLINE
+from plugin_router import PluginRouter, find_plugins
+from scheduler import Scheduler
+from pipeline import Pipeline, Stage, OVERFLOW_POLICIES, OVERFLOW_BLOCK, OVERFLOW_DROP_OLDEST
+from sinks import Sinks, ThingsboardSink, MqttSink, ArchiveSink, load_sinks
+import serialization
+from mqtt_class import Mqtt, RawForwarder
 
 import logging
 
-class DataPointType(Enum):
-  attribute = 0
-  telemetry = 1
+# default stage configuration: name -> (workers, queue size, overflow policy)
+# the parse queue drops the oldest frames when full, so the modem read thread never blocks
+PIPELINE_STAGES = [
+  ("parse", 1, 1000, OVERFLOW_DROP_OLDEST),
+  ("enrich", 1, 1000, OVERFLOW_BLOCK),
+  ("publish", 1, 1000, OVERFLOW_BLOCK)
+]
 
 class Gateway:
-  def __init__(self):
+  def __init__(self, args=None):
     argparser = argparse.ArgumentParser()
-    argparser.add_argument("-d", "--device", help="serial device /dev file modem", default="/dev/ttyACM0")
-    argparser.add_argument("-r", "--rate", help="baudrate for serial device", type=int, default=115200)
+    argparser.add_argument("-d", "--device", help="serial device /dev file modem, repeat to use multiple modems (default /dev/ttyACM0)",
+                           action="append", default=[])
+    argparser.add_argument("-r", "--rate", help="baudrate for serial devices", type=int, default=115200)
     argparser.add_argument("-v", "--verbose", help="verbose", default=False, action="store_true")
     argparser.add_argument("-m", "--mqtt-broker", help="MQTT broker to publish alp commands to", default="backend.idlab.uantwerpen.be")
     argparser.add_argument("-mt", "--mqtt-topic", help="MQTT publish topic", default="/d7")
+    argparser.add_argument("-mq", "--mqtt-qos", help="QoS of the messages published to the MQTT broker", type=int,
+                           choices=[0, 1, 2], default=0)
+    argparser.add_argument("-mb", "--mqtt-buffer-size", help="Number of messages buffered while the MQTT broker is not reachable",
+                           type=int, default=10000)
+    argparser.add_argument("-mf", "--mqtt-inflight", help="Maximum number of messages in flight to the MQTT broker", type=int, default=20)
+    argparser.add_argument("-ma", "--mqtt-aggregate-interval", help="Publish the ALP commands received during this number of seconds "
+                           "together on topic <mqtt-topic>/<modem uid> (0 publishes each command on <mqtt-topic>/<node id>/<modem uid>)",
+                           type=float, default=0)
+    argparser.add_argument("-mx", "--mqtt-aggregate-max", help="Maximum number of ALP commands in one aggregated message", type=int,
+                           default=100)
     argparser.add_argument("-et", "--enable-thingsboard", help="Enable to forward data to TB", default=False)
     argparser.add_argument("-t", "--token", help="Access token for the TB gateway", default=None)
     argparser.add_argument("-tb", "--thingsboard", help="Thingsboard hostname/IP", default="localhost")
     argparser.add_argument("-p", "--plugin-path", help="path where plugins are stored", default="")
+    argparser.add_argument("-pe", "--plugin-execution", help="Run plugins inline, or in a pool of threads or processes with a timeout",
+                           choices=EXECUTION_MODES, default=EXECUTION_INLINE)
+    argparser.add_argument("-pw", "--plugin-workers", help="Number of plugins running at the same time in the pool, also the default "
+                           "number of parse workers", type=int, default=2)
+    argparser.add_argument("-pt", "--plugin-timeout", help="Seconds a plugin may take to parse a file when running in a pool",
+                           type=float, default=5)
+    argparser.add_argument("-pf", "--plugin-max-failures", help="Disable a plugin after it failed or timed out this number of times "
+                           "in a row", type=int, default=5)
+    argparser.add_argument("-pr", "--plugin-retry", help="Seconds after which a disabled plugin is tried again", type=float, default=300)
     argparser.add_argument("-bp", "--broker-port", help="mqtt broker port",
                            default="1883")
     argparser.add_argument("-l", "--logfile", help="specify path if you want to log to file instead of to stdout",
@@ -56,14 +90,75 @@ class Gateway:
     argparser.add_argument("-k", "--keep-data", help="Save data locally when Thingsboard is disconnected and send it when connection is restored.",
                            default=True)
     argparser.add_argument("-b", "--save-bandwidth", help="Send data in binary format to save bandwidth", action="store_true")
+    argparser.add_argument("-bu", "--binary-uplink-interval", help="In save bandwidth mode, pack the ALP commands received during this "
+                           "number of seconds in one compressed blob published on <mqtt-topic>/binary/<modem uid> (0 sends each "
+                           "command as attribute to TB)", type=float, default=0)
+    argparser.add_argument("-bf", "--binary-uplink-max-frames", help="Maximum number of ALP commands in one binary uplink blob",
+                           type=int, default=100)
+    argparser.add_argument("-bc", "--binary-uplink-compression", help="Compression of the binary uplink blobs",
+                           choices=COMPRESSION_METHODS, default=COMPRESSION_ZLIB)
+    argparser.add_argument("-bd", "--binary-uplink-dictionary", help="Preset dictionary used to compress the binary uplink blobs, "
+                           "trained with alp_framing.py", default=None)
     argparser.add_argument("-sf", "--skip-system-files", help="Do not read system files on boot", action="store_true")
-
-    self.bridge_count = 0
-    self.next_report = 0
-    self.config = argparser.parse_args()
+    argparser.add_argument("-sc", "--system-file-cache", help="File in which the system files of the modems are cached, so they are "
+                           "not all read again after a restart (empty disables)", default="system-files.json")
+    argparser.add_argument("-sa", "--system-file-max-age", help="Read cached system files again when they are older than this number "
+                           "of seconds", type=float, default=24 * 3600)
+    argparser.add_argument("-q", "--queue-file", help="File used to store data while Thingsboard is disconnected", default="offline-queue.db")
+    argparser.add_argument("-qm", "--queue-max-messages", help="Maximum number of messages stored while Thingsboard is disconnected",
+                           type=int, default=100000)
+    argparser.add_argument("-qs", "--queue-max-size", help="Maximum size in MB of the messages stored while Thingsboard is disconnected",
+                           type=float, default=50)
+    argparser.add_argument("-qe", "--queue-eviction", help="Which messages to drop when the queue is full",
+                           choices=EVICTION_POLICIES, default=EVICT_DROP_OLDEST)
+    argparser.add_argument("-bi", "--batch-interval", help="Batch telemetry and attributes sent to TB during this number of seconds (0 disables batching)",
+                           type=float, default=0)
+    argparser.add_argument("-bs", "--batch-size", help="Maximum number of values in a batch before it is sent to TB",
+                           type=int, default=100)
+    argparser.add_argument("-ac", "--attribute-cache-size", help="Number of devices for which the last sent attributes are remembered, "
+                           "so unchanged attributes are not sent again (0 disables)", type=int, default=1000)
+    argparser.add_argument("-am", "--attribute-max-age", help="Send unchanged attributes again after this number of seconds (0 disables)",
+                           type=float, default=3600)
+    argparser.add_argument("-ag", "--aggregation-config", help="JSON file with rules to aggregate device telemetry over time windows "
+                           "before it is sent to TB", default="")
+    argparser.add_argument("-dw", "--dedup-window", help="Drop frames received again from the same node within this number of seconds "
+                           "(0 disables)", type=float, default=2)
+    argparser.add_argument("-dc", "--dedup-capacity", help="Number of frames remembered for duplicate detection", type=int, default=1024)
+    argparser.add_argument("-dd", "--downlink-duty-cycle", help="Fraction of the time the modems may transmit commands received "
+                           "through RPC", type=float, default=0.01)
+    argparser.add_argument("-db", "--downlink-burst", help="Airtime in seconds which can be used at once for commands received through RPC",
+                           type=float, default=0.1)
+    argparser.add_argument("-dt", "--downlink-timeout", help="Seconds to wait for the response to a command received through RPC",
+                           type=float, default=30)
+    argparser.add_argument("-ps", "--pipeline-stage", help="Configure a pipeline stage (parse, enrich or publish) as "
+                           "name:workers:queue-size:overflow, overflow is one of {}".format(", ".join(OVERFLOW_POLICIES)),
+                           action="append", default=[])
+    argparser.add_argument("-sk", "--sinks-config", help="JSON file configuring additional destinations of the frames", default="")
+    argparser.add_argument("-sq", "--sink-queue-size", help="Number of frames queued for Thingsboard and the MQTT broker",
+                           type=int, default=1000)
+    argparser.add_argument("-so", "--sink-overflow", help="What to do when the queue of Thingsboard or the MQTT broker is full",
+                           choices=OVERFLOW_POLICIES, default=OVERFLOW_DROP_OLDEST)
+    argparser.add_argument("-ar", "--archive-dir", help="Directory in which the received ALP commands are archived, so they can be "
+                           "replayed through the replay-archive RPC method (empty disables)", default="")
+    argparser.add_argument("-as", "--archive-max-size", help="Maximum size in MB of the archive", type=float, default=1024)
+    argparser.add_argument("-aa", "--archive-max-age", help="Remove archived commands after this number of days (0 disables)",
+                           type=float, default=0)
+    argparser.add_argument("-sd", "--spill-dir", help="Directory for pipeline stages spilling to disk", default="")
+    argparser.add_argument("-mp", "--metrics-port", help="Serve metrics in Prometheus format on this HTTP port (0 disables)",
+                           type=int, default=0)
+    argparser.add_argument("-mi", "--metrics-interval", help="Send metrics as gateway telemetry to TB every number of seconds (0 disables)",
+                           type=float, default=0)
+
+    self.first_frame_seconds = None
+    self.forwarded_reported = 0
+    self.config = argparser.parse_args(args)
     self.log = logging.getLogger()
 
-    self.m = Mqtt(self.config.mqtt_broker, 1883)
+    self.metrics = Registry()
+    self.frames_forwarded = self.metrics.counter("frames_forwarded_total", "Frames forwarded to the sinks")
+    self.frame_latency = self.metrics.histogram("frame_latency_seconds", "Time from receiving a frame until it is forwarded")
+    self.plugin_time = self.metrics.histogram("plugin_seconds", "Time spent parsing file data per plugin")
+    self.plugin_errors = self.metrics.counter("plugin_errors_total", "Exceptions raised by plugins")
 
     formatter = logging.Formatter('%(asctime)s %(name)-12s %(levelname)-8s %(message)s')
     if self.config.logfile == "":
@@ -77,39 +172,158 @@ class Gateway:
     if self.config.verbose:
       self.log.setLevel(logging.DEBUG)
 
+    # the process pool is forked before any other thread is started, forking a process with threads can deadlock the
+    # children on locks held by those threads
+    self.plugin_router = PluginRouter()
+    self.plugin_executor = PluginExecutor(self.config.plugin_execution, self.config.plugin_workers, self.config.plugin_timeout,
+                                          self.config.plugin_max_failures, self.config.plugin_retry,
+                                          loader=(find_plugins, (self.config.plugin_path,)) if self.config.plugin_path != "" else None)
+    self.plugin_executor.instrument(self.metrics)
+    if self.config.plugin_path != "":
+      self.load_plugins(self.config.plugin_path)
+    self.plugin_executor.start()
+
+    # heartbeats, flushes, cache expiry and reporting all run on this thread, instead of a timer or thread each
+    self.scheduler = Scheduler()
+    self.scheduler.instrument(self.metrics)
+    self.scheduler.start()
+    self.stopped = Event()
+
+    self.m = Mqtt(self.config.mqtt_broker, int(self.config.broker_port), qos=self.config.mqtt_qos,
+                  buffer_size=self.config.mqtt_buffer_size, max_inflight=self.config.mqtt_inflight)
+    self.forwarder = RawForwarder(self.m, self.config.mqtt_topic, self.config.mqtt_aggregate_interval, self.config.mqtt_aggregate_max,
+                                  self.scheduler)
+
     heartbeat_interval_seconds = 5
     if self.config.save_bandwidth:
       heartbeat_interval_seconds = 5 * 60
 
+    # the modules of optional features are only imported when the feature is enabled, so they do not slow down the start
     self.thingsboard_enabled = self.config.enable_thingsboard
     if self.thingsboard_enabled:
-      self.tb = Thingsboard(self.config.thingsboard, self.config.token, self.on_mqtt_message,
-                            persistData=self.config.keep_data, heartbeat_interval_seconds=heartbeat_interval_seconds)
-
-    if self.config.plugin_path != "":
-      self.load_plugins(self.config.plugin_path)
+      from thingsboard import Thingsboard
 
-    self.modem = Modem(self.config.device, self.config.rate, self.on_command_received, self.config.save_bandwidth)
-    connected = self.modem.connect()
-    while not connected:
-      try:
-        self.log.warning("Not connected to modem, retrying ...")
-        time.sleep(1)
-        connected = self.modem.connect()
-      except KeyboardInterrupt:
-        self.log.info("received KeyboardInterrupt... stopping")
-        if self.thingsboard_enabled:
-          self.tb.disconnect()
-        exit(-1)
-      except:
-        exc_type, exc_value, exc_traceback = sys.exc_info()
-        lines = traceback.format_exception(exc_type, exc_value, exc_traceback)
-        trace = "".join(lines)
-        self.log.error("Exception while connecting modem: \n{}".format(trace))
+      attribute_cache = None
+      if self.config.attribute_cache_size > 0:
+        from attribute_cache import AttributeCache
+        attribute_cache = AttributeCache(self.config.attribute_cache_size, self.config.attribute_max_age)
+        if self.config.attribute_max_age > 0:
+          self.scheduler.call_every(self.config.attribute_max_age, attribute_cache.expire, "attribute-cache-expiry")
 
-    # switch to continuous foreground scan access profile
-    self.modem.execute_command(
-      Command.create_with_write_file_action_system_file(DllConfigFile(active_access_class=0x01)), timeout_seconds=1)
+      self.tb = Thingsboard(self.config.thingsboard, self.config.token, self.on_mqtt_message,
+                            persistData=self.config.keep_data, heartbeat_interval_seconds=heartbeat_interval_seconds,
+                            batch_interval_seconds=self.config.batch_interval, batch_max_size=self.config.batch_size,
+                            queue_file=self.config.queue_file, queue_max_messages=self.config.queue_max_messages,
+                            queue_max_bytes=int(self.config.queue_max_size * 1024 * 1024),
+                            queue_eviction=self.config.queue_eviction, attribute_cache=attribute_cache,
+                            scheduler=self.scheduler)
+      self.tb.instrument(self.metrics)
+
+    self.aggregator = None
+    if self.thingsboard_enabled and self.config.aggregation_config != "":
+      from aggregation import Aggregator, load_rules
+
+      self.aggregator = Aggregator(load_rules(self.config.aggregation_config), self.tb.sendDeviceTelemetry, scheduler=self.scheduler)
+      self.metrics.counter("aggregated_samples_total", "Telemetry samples aggregated", lambda: self.aggregator.samples)
+      self.metrics.counter("aggregates_published_total", "Aggregated telemetry messages sent", lambda: self.aggregator.published)
+      self.metrics.counter("aggregation_late_samples_total", "Samples of closed windows sent without aggregating",
+                           lambda: self.aggregator.late)
+      self.aggregator.start()
+
+    self.duplicate_filter = None
+    if self.config.dedup_window > 0:
+      from dedup import DuplicateFilter
+
+      self.duplicate_filter = DuplicateFilter(self.config.dedup_window, self.config.dedup_capacity)
+
+    self.binary_uplink = None
+    if self.config.save_bandwidth and self.config.binary_uplink_interval > 0:
+      from alp_framing import FrameBatcher, load_dictionary
+
+      dictionary = None
+      if self.config.binary_uplink_dictionary is not None:
+        dictionary = load_dictionary(self.config.binary_uplink_dictionary)
+
+      self.binary_uplink = FrameBatcher(self.publish_binary_uplink, self.config.binary_uplink_interval,
+                                        self.config.binary_uplink_max_frames, self.config.binary_uplink_compression, dictionary,
+                                        self.scheduler)
+
+    # RPC commands are sent to the modems by the downlink scheduler, never on the MQTT network thread
+    self.downlink = DownlinkScheduler(self.send_downlink, self.send_rpc_response, self.config.downlink_duty_cycle,
+                                      self.config.downlink_burst, response_timeout_seconds=self.config.downlink_timeout)
+    self.downlink.instrument(self.metrics)
+    self.downlink.start()
+
+    self.system_file_cache = None
+    if not self.config.skip_system_files and self.config.system_file_cache != "":
+      from system_file_cache import SystemFileCache
+
+      self.system_file_cache = SystemFileCache(self.config.system_file_cache, self.config.system_file_max_age,
+                                               scheduler=self.scheduler)
+
+    # every destination has its own queue and worker, so a slow destination does not hold up the others
+    self.sinks = Sinks(self.config.spill_dir, self.on_frame_delivered)
+    if self.thingsboard_enabled:
+      self.sinks.add(ThingsboardSink(self.tb, self.aggregator), self.config.sink_queue_size, self.config.sink_overflow)
+    self.sinks.add(MqttSink(self.forwarder, self.binary_uplink), self.config.sink_queue_size, self.config.sink_overflow)
+    if self.config.archive_dir != "":
+      from frame_archive import FrameArchive
+
+      archive = FrameArchive(self.config.archive_dir, max_bytes=int(self.config.archive_max_size * 1024 * 1024),
+                             max_age_seconds=self.config.archive_max_age * 24 * 3600)
+      self.sinks.add(ArchiveSink(archive), self.config.sink_queue_size, self.config.sink_overflow)
+    if self.config.sinks_config != "":
+      for sink, queue_size, overflow, retries in load_sinks(self.config.sinks_config, self.scheduler):
+        self.sinks.add(sink, queue_size, overflow, retries)
+    archives = [sink.archive for sink in self.sinks.sinks if isinstance(sink, ArchiveSink)]
+    self.archive = archives[0] if archives else None
+    if self.archive is not None:
+      self.metrics.gauge("archive_bytes", "Size of the frame archive", lambda: self.archive.stats()['bytes'])
+      # segments are otherwise only removed when a new one is started, which can take long with little traffic
+      self.scheduler.call_every(3600, self.archive.enforce_retention, "archive-retention")
+    self.sinks.instrument(self.metrics)
+    self.sinks.start()
+
+    self.pipeline = self.create_pipeline()
+    self.pipeline.instrument(self.metrics)
+    self.pipeline.start()
+
+    # each modem connects on its own thread, they share the pipeline and the Thingsboard and MQTT connections
+    self.modems = [
+      GatewayModem(device, self.config.rate, self.on_command_received, self.on_modem_connected, self.config.save_bandwidth)
+      for device in (self.config.device or ["/dev/ttyACM0"])
+    ]
+    for modem in self.modems:
+      modem.start()
+
+    self.metrics.counter("frames_received_total", "Frames received per modem",
+                         lambda: dict((modem.uid or modem.device, modem.received) for modem in self.modems), label="modem")
+    self.metrics.gauge("mqtt_connected", "Connected to the MQTT broker", lambda: int(self.m.connected_to_mqtt))
+    self.metrics.counter("mqtt_reconnects_total", "Reconnections to the MQTT broker", lambda: self.m.connection.reconnects)
+    self.metrics.gauge("mqtt_buffered", "Messages buffered for the MQTT broker", lambda: len(self.m.buffer))
+    self.metrics.gauge("mqtt_inflight", "Messages in flight to the MQTT broker", lambda: len(self.m.inflight))
+    self.metrics.counter("mqtt_dropped_total", "Messages dropped because the MQTT buffer was full", lambda: self.m.dropped)
+    self.metrics.gauge("first_frame_seconds", "Time from the start of the gateway until the first frame was forwarded",
+                       lambda: self.first_frame_seconds)
+    if self.duplicate_filter is not None:
+      self.metrics.counter("duplicate_frames_total", "Duplicate frames dropped", lambda: self.duplicate_filter.hits)
+
+    if self.binary_uplink is not None:
+      self.metrics.counter("binary_uplink_raw_bytes_total", "Size of the ALP commands sent in binary uplink blobs",
+                           lambda: self.binary_uplink.raw_bytes)
+      self.metrics.counter("binary_uplink_encoded_bytes_total", "Size of the binary uplink blobs",
+                           lambda: self.binary_uplink.encoded_bytes)
+
+    self.metrics_server = None
+    if self.config.metrics_port > 0:
+      from metrics import MetricsServer
+
+      self.metrics_server = MetricsServer(self.metrics, self.config.metrics_port)
+      self.metrics_server.start()
+
+    if self.thingsboard_enabled and self.config.metrics_interval > 0:
+      self.scheduler.call_every(self.config.metrics_interval, self.report_metrics, delay=0)
+    self.scheduler.call_every(15, self.report_stats)
 
     if self.config.save_bandwidth:
       self.log.info("Running in save bandwidth mode")
@@ -117,107 +331,238 @@ class Gateway:
         self.log.warning("Save bandwidth mode is enabled, plugin files will not be used")
 
     # update attribute containing git rev so we can track revision at TB platform
-    git_sha = subprocess.check_output(["git", "describe", "--always"]).strip()
+    git_sha = git_revision()
     ip = self.get_ip()
     if self.thingsboard_enabled:
-      self.tb.sendGwAttributes({'UID': self.modem.uid, 'git-rev': git_sha, 'IP': ip, 'save bw': str(self.config.save_bandwidth)})
+      self.tb.sendGwAttributes({'git-rev': git_sha, 'IP': ip, 'save bw': str(self.config.save_bandwidth)})
 
-    self.log.info("Running on {} with git rev {} using modem {}".format(ip, git_sha, self.modem.uid))
+    self.log.info("Running on {} with git rev {} using {} modem(s)".format(ip, git_sha, len(self.modems)))
 
-    # read all system files on the local node to store as attributes on TB
-    if not self.config.skip_system_files:
-      self.log.info("Reading all system files ...")
-      for file in SystemFiles().files.values():
-        self.modem.execute_command_async(
-          Command.create_with_read_file_action_system_file(file)
-        )
+  @property
+  def modem(self):
+    # the first modem is used for commands which are not addressed to a specific modem
+    return self.modems[0]
 
-  def load_plugins(self, plugin_path):
-    self.log.info("Searching for plugins in path %s" % plugin_path)
-    manager = PluginManagerSingleton.get()
-    manager.setPluginPlaces([plugin_path])
-    manager.collectPlugins()
+  def modem_for(self, uid):
+    for modem in self.modems:
+      if modem.uid == uid:
+        return modem
 
-    for plugin in manager.getAllPlugins():
-      self.log.info("Loading plugin '%s'" % plugin.name)
+    return self.modem
 
-  def on_command_received(self, cmd):
-    try:
-      # publish raw ALP command to backend.idlab.uantwerpen.be MQTT broker
-      if self.config.save_bandwidth:
-        self.log.info("Command received: binary ALP (size {})".format(len(cmd)))
-      else:
-        self.log.info("Command received: {}".format(cmd))
+  def on_modem_connected(self, modem):
+    # switch to continuous foreground scan access profile
+    modem.execute_command(
+      Command.create_with_write_file_action_system_file(DllConfigFile(active_access_class=0x01)), timeout_seconds=1)
 
-      ts = int(round(time.time() * 1000))
+    if self.thingsboard_enabled:
+      uids = [m.uid for m in self.modems if m.uid is not None]
+      self.tb.sendGwAttributes({'UID': self.modem.uid or uids[0], 'modems': ",".join(uids)})
 
-      if self.thingsboard_enabled:
-        # publish raw ALP command to incoming ALP topic, we will not parse the file contents here (since we don't know how)
-        # so pass it as an opaque BLOB for parsing in backend
-        if self.config.save_bandwidth:
+    # read the system files on the local node to store as attributes on TB, files read recently are taken from the cache
+    if not self.config.skip_system_files:
+      cached = {}
+      if self.system_file_cache is not None:
+        cached = self.system_file_cache.fresh(modem.uid, modem.firmware_version)
+        if cached and self.thingsboard_enabled:
+          self.tb.sendGwAttributes(dict((self.system_file_attribute(modem.uid, file_id), value) for file_id, value in cached.items()))
+
+      # the reads are queued at low priority, one at a time, so they do not delay live traffic
+      stale = [file for file_id, file in SystemFiles().files.items() if file_id.value not in cached]
+      self.log.info("Reading {} system files of modem {} ({} cached) ...".format(len(stale), modem.uid, len(cached)))
+      for file in stale:
+        self.downlink.submit(modem.uid, None, Command.create_with_read_file_action_system_file(file), PRIORITY_LOW, airtime=0)
+
+  def system_file_attribute(self, modem_uid, file_id):
+    name = "File {}".format(file_id)
+    if len(self.modems) > 1:
+      name = "{} {}".format(modem_uid, name)
+    return name
 
-          if self.thingsboard_enabled:
-            self.tb.sendGwAttributes({'alp': binascii.hexlify(bytearray(cmd))})
-          return
+  def load_plugins(self, plugin_path):
+    self.log.info("Searching for plugins in path %s" % plugin_path)
+    for name, plugin in find_plugins(plugin_path):
+      self.log.info("Loading plugin '%s'" % name)
+      self.plugin_router.add_plugin(name, plugin)
+      self.plugin_executor.add_plugin(name, plugin)
+
+  def create_pipeline(self):
+    handlers = {
+      "parse": self.parse_command,
+      "enrich": self.enrich_frame,
+      "publish": self.publish_frame
+    }
+    config = dict((name, (workers, size, overflow)) for name, workers, size, overflow in PIPELINE_STAGES)
+    if self.config.plugin_execution != EXECUTION_INLINE:
+      # frames are only parsed in parallel by multiple parse workers
+      workers, size, overflow = config["parse"]
+      config["parse"] = (self.config.plugin_workers, size, overflow)
+    for stage_config in self.config.pipeline_stage:
+      name, workers, size, overflow = stage_config.split(":")
+      if name not in handlers:
+        raise ValueError("unknown pipeline stage {}".format(name))
+
+      config[name] = (int(workers), int(size), overflow)
+
+    return Pipeline([
+      Stage(name, handlers[name], workers=config[name][0], max_size=config[name][1], overflow=config[name][2],
+            spill_dir=self.config.spill_dir)
+      for name, _, _, _ in PIPELINE_STAGES
+    ])
+
+  def on_command_received(self, modem, cmd):
+    # called on the modem read thread, only queue the command here so reading the serial port is never delayed
+    self.downlink.on_command_received(cmd)
+    self.pipeline.put((modem.uid, cmd, int(round(time.time() * 1000)), False))
+
+  def replay_archive(self, start_ms, end_ms, node_id=None):
+    """ passes the archived commands through the pipeline again, returns the number of commands """
+    from bitstring import ConstBitStream
+    from d7a.alp.parser import Parser
+
+    stage = self.pipeline.stages[0]
+    count = 0
+    for ts, modem_uid, _, data in self.archive.read(start_ms, end_ms, node_id):
+      # leave room in the queue for the frames received in the meantime, so the replay never makes them overflow
+      while stage.queue.qsize() > stage.max_size // 2:
+        time.sleep(0.05)
 
-        self.tb.sendGwAttributes({'alp': jsonpickle.encode(cmd), 'last_seen': str(datetime.now().strftime("%y-%m-%d %H:%M:%S"))})
-
-      node_id = self.modem.uid # overwritten below with remote node ID when received over D7 interface
-      # parse link budget (when this is received over D7 interface) and publish separately so we can visualize this in TB
-      if cmd.interface_status != None and cmd.interface_status.operand.interface_id == 0xd7:
-        interface_status = cmd.interface_status.operand.interface_status
-        node_id = '{:x}'.format(interface_status.addressee.id)
-        linkBudget = interface_status.link_budget
-        rxLevel = interface_status.rx_level
-        lastConnect = "D7-" + interface_status.get_short_channel_string()
-        if self.thingsboard_enabled:
-          self.tb.sendDeviceTelemetry(node_id, ts, {'lb': linkBudget, 'rx': rxLevel})
-          self.tb.sendDeviceAttributes(node_id, {'last_conn': lastConnect, 'last_gw': self.modem.uid})
-
-      # publish raw ALP command to MQTT broker on topic "/d7/<node_id>/<gateway_id>"
-      if self.m.connected_to_mqtt:
-        self.m.publish_message(self.config.mqtt_topic + "/" + node_id + "/" + self.modem.uid, binascii.hexlify(bytearray(cmd)))
-
-      # store returned file data as attribute on the device
-      for action in cmd.actions:
-        if type(action.operation) is ReturnFileData:
-          data = ""
-          if action.operation.file_data_parsed is not None:
-            if not self.config.save_bandwidth:
-              # for known system files we transmit the parsed data
-              data = jsonpickle.encode(action.operation.file_data_parsed)
-              file_id = "File {}".format(action.operand.offset.id)
-              if self.thingsboard_enabled:
-                self.tb.sendGwAttributes({file_id: data})
-          else:
-            # try if plugin can parse this file
-            parsed_by_plugin = False
-            if not self.config.save_bandwidth:
-              for plugin in PluginManagerSingleton.get().getAllPlugins():
-                for name, value, datapoint_type in plugin.plugin_object.parse_file_data(action.operand.offset, action.operand.length, action.operand.data):
-                  parsed_by_plugin = True
-                  if isinstance(value, int) or isinstance(value, float):
-                    if self.thingsboard_enabled:
-                      self.tb.sendDeviceTelemetry(node_id, ts, {name: value})
-                  else:
-                    if self.thingsboard_enabled:
-                      self.tb.sendDeviceAttributes(node_id, {name: value})
-
-            if not parsed_by_plugin:
-              # unknown file content, just transmit raw data
-              data = jsonpickle.encode(action.operand)
-              filename = "File {}".format(action.operand.offset.id)
-              if action.operation.systemfile_type != None:
-                filename = "File {} ({})".format(SystemFileIds(action.operand.offset.id).name, action.operand.offset.id)
-                if self.thingsboard_enabled:
-                  self.tb.sendDeviceAttributes(node_id, {filename: data})
+      if self.config.save_bandwidth:
+        cmd = bytearray(data)
+      else:
+        cmd = Parser().parse(ConstBitStream(bytes=bytes(data)), len(data))
+      self.pipeline.put((modem_uid, cmd, ts, True))
+      count += 1
 
+    self.log.info("Replayed {} archived commands".format(count))
+    return count
 
-    except:
-      exc_type, exc_value, exc_traceback = sys.exc_info()
-      lines = traceback.format_exception(exc_type, exc_value, exc_traceback)
-      trace = "".join(lines)
-      self.log.error("Exception while processing command: \n{}".format(trace))
+  def parse_command(self, item):
+    modem_uid, cmd, ts, replayed = item
+    if self.config.save_bandwidth:
+      self.log.info("Command received: binary ALP (size {})".format(len(cmd)))
+      # pass the raw ALP command as an opaque BLOB for parsing in backend
+      frame = Frame(cmd, ts, modem_uid, binary=True)
+      frame.replayed = replayed
+      if self.binary_uplink is None:
+        frame.gw_attributes['alp'] = bytearray(cmd)  # serialized as hex string
+      return frame
+
+    self.log.info("Command received: {}".format(cmd))
+    frame = Frame(cmd, ts, modem_uid)
+    frame.replayed = replayed
+    frame.gw_attributes['alp'] = cmd
+
+    # parse link budget (when this is received over D7 interface) and publish separately so we can visualize this in TB
+    if cmd.interface_status != None and cmd.interface_status.operand.interface_id == 0xd7:
+      frame.interface_status = cmd.interface_status.operand.interface_status
+      frame.node_id = '{:x}'.format(frame.interface_status.addressee.id)
+      frame.device_telemetry['lb'] = frame.interface_status.link_budget
+      frame.device_telemetry['rx'] = frame.interface_status.rx_level
+
+      # archived frames were checked for duplicates when they were received
+      if self.duplicate_filter is not None and not replayed:
+        duplicate = self.duplicate_filter.check(self.frame_key(frame), ts, frame.interface_status.link_budget)
+        if duplicate is not None:
+          first_ts, improved = duplicate
+          self.log.info("Dropping duplicate frame from {} (better link budget: {})".format(frame.node_id, improved))
+          if not improved:
+            return None
+
+          # only update the link budget, stored at the timestamp of the first copy so it replaces that value
+          frame.timestamp = first_ts
+          frame.duplicate = True
+          frame.gw_attributes = {}
+          frame.interface_status = None
+          return frame
+
+    # store returned file data as attribute on the device
+    for action in cmd.actions:
+      if type(action.operation) is ReturnFileData:
+        if action.operation.file_data_parsed is not None:
+          # for known system files we transmit the parsed data
+          file_id = action.operand.offset.id
+          frame.gw_attributes[self.system_file_attribute(modem_uid, file_id)] = action.operation.file_data_parsed
+          if self.system_file_cache is not None and frame.interface_status is None and not replayed:
+            # read from the modem itself, cache the value as it is sent to TB
+            value = json.loads(serialization.dumps(action.operation.file_data_parsed).decode("utf-8"))
+            self.system_file_cache.update(modem_uid, self.modem_for(modem_uid).firmware_version, file_id, value)
+        else:
+          # try if plugin can parse this file
+          parsed_by_plugin = False
+          for plugin_name, plugin in self.plugin_router.plugins_for(action.operand.offset, action.operand.length):
+            start = time.time()
+            try:
+              values = self.plugin_executor.parse(plugin_name, plugin, action.operand.offset, action.operand.length, action.operand.data)
+              for name, value, datapoint_type in values:
+                parsed_by_plugin = True
+                if datapoint_type == DataPointType.telemetry:
+                  frame.device_telemetry[name] = value
+                else:
+                  frame.device_attributes[name] = value
+            except Exception:
+              self.plugin_errors.inc(plugin=plugin_name)
+              self.log.exception("Plugin '{}' failed to parse file {}".format(plugin_name, action.operand.offset.id))
+
+            self.plugin_time.observe(time.time() - start, plugin=plugin_name)
+
+          if not parsed_by_plugin:
+            # unknown file content, just transmit raw data
+            if action.operation.systemfile_type != None:
+              filename = "File {} ({})".format(SystemFileIds(action.operand.offset.id).name, action.operand.offset.id)
+              frame.device_attributes[filename] = action.operand
+
+    return frame
+
+  def frame_key(self, frame):
+    # retransmissions of a frame have the same sequence number and FIFO token
+    status = frame.interface_status
+    payload = b"".join(bytes(bytearray(action)) for action in frame.cmd.actions)
+    return (status.addressee.id, status.seq_nr, status.fifo_token, hash(payload))
+
+  def enrich_frame(self, frame):
+    if frame.replayed:
+      # only the device data is sent again, not the state of the gateway or the last connection at the time
+      frame.gw_attributes = {}
+      return frame
+
+    if frame.binary:
+      return frame
+
+    frame.gw_attributes['last_seen'] = str(datetime.now().strftime("%y-%m-%d %H:%M:%S"))
+    if frame.interface_status is not None:
+      frame.device_attributes['last_conn'] = "D7-" + frame.interface_status.get_short_channel_string()
+      frame.device_attributes['last_gw'] = frame.modem_uid
+
+    return frame
+
+  def publish_frame(self, frame):
+    # only queues the frame for the sinks
+    self.sinks.put(frame)
+
+    self.frames_forwarded.inc()
+    if not frame.replayed:
+      self.frame_latency.observe(time.time() - frame.timestamp / 1000.0)
+
+  def on_frame_delivered(self, sink, frame):
+    # the time to the first forwarded frame runs until a frame is handed to the MQTT client of ThingsBoard or the broker,
+    # not until it is queued for the sinks
+    if self.first_frame_seconds is None and isinstance(sink, (ThingsboardSink, MqttSink)):
+      self.first_frame_seconds = time.time() - STARTED
+      self.log.info("First frame forwarded {:.2f} s after start".format(self.first_frame_seconds))
+
+  def publish_binary_uplink(self, modem_uid, blob):
+    # blobs are decoded in the backend using alp_framing.decode_frames
+    self.m.publish_message(self.config.mqtt_topic + "/binary/" + modem_uid, blob)
+
+  def send_downlink(self, downlink):
+    # commands for one of our modems are executed by that modem, others by the first modem
+    self.modem_for(downlink.device).execute_command_async(downlink.command)
+
+  def send_rpc_response(self, device, request_id, data):
+    # commands queued by the gateway itself have no request ID
+    if self.thingsboard_enabled and request_id is not None:
+      self.tb.sendRpcResponse(device, request_id, data)
 
   def on_mqtt_message(self, client, config, msg):
     try:
@@ -226,49 +571,66 @@ class Gateway:
       method = payload['data']['method']
       request_id = payload['data']['id']
       self.log.info("Received RPC command of type {} for {} (request id {})".format(method, uid, request_id))
-      # if uid != self.modem.uid:
-      #   self.log.info("RPC command not for this modem ({}), skipping".format(self.modem.uid))
-      #   return
+      priority = PRIORITIES.get(payload['data'].get('priority'), PRIORITY_NORMAL)
 
       if method == "execute-alp-async":
         try:
           cmd = payload['data']['params']
           self.log.info("Received command through RPC: %s" % cmd)
 
-          self.modem.execute_command_async(cmd)
-          self.log.info("Executed ALP command through RPC")
+          self.downlink.submit(uid, request_id, cmd, priority, coalesce_key(cmd))
+          self.log.info("Queued ALP command received through RPC")
 
           # TODO when the command is writing local files we could read them again automatically afterwards, to make sure the digital twin is updated
         except Exception as e:
           self.log.exception("Could not deserialize: %s" % e)
       elif method == "alert":
         # TODO needs refactoring so different methods can be supported in a plugin, for now this is very specific case as an example
-        self.log.info("Alert (payload={})".format(msg.payload))
-        if msg.payload != "true" and msg.payload != "false":
+        params = payload['data'].get('params')
+        self.log.info("Alert (params={})".format(params))
+        if params not in (True, False, "true", "false"):
           self.log.info("invalid payload, skipping")
           return
 
         file_data = 0
-        if msg.payload == "true":
+        if params in (True, "true"):
           file_data = 1
 
         self.log.info("writing alert file")
-        self.modem.execute_command_async(
-          Command.create_with_write_file_action(
-            file_id=0x60,
-            offset=4,
-            data=[file_data],
-            interface_type=InterfaceType.D7ASP,
-            interface_configuration=Configuration(
-              qos=QoS(resp_mod=ResponseMode.RESP_MODE_ALL),
-              addressee=Addressee(
-                access_class=0x11,
-                id_type=IdType.NOID
-              )
+        cmd = Command.create_with_write_file_action(
+          file_id=0x60,
+          offset=4,
+          data=[file_data],
+          interface_type=InterfaceType.D7ASP,
+          interface_configuration=Configuration(
+            qos=QoS(resp_mod=ResponseMode.RESP_MODE_ALL),
+            addressee=Addressee(
+              access_class=0x11,
+              id_type=IdType.NOID
             )
           )
         )
+        # alerts are sent before other commands, an alert replaces a previous one which was not sent yet
+        self.downlink.submit(uid, request_id, cmd, PRIORITIES.get(payload['data'].get('priority'), PRIORITY_HIGH), coalesce_key(cmd))
+
+      elif method == "replay-archive":
+        # parse the archived commands of the device again, for example after adding a plugin, and send the result to TB
+        params = payload['data'].get('params') or {}
+        if self.archive is None:
+          self.send_rpc_response(uid, request_id, {"status": "error", "error": "no archive configured"})
+          return
+
+        start_ms = int(params.get('from', 0))
+        end_ms = int(params['to']) if params.get('to') is not None else None
 
+        def replay():
+          count = self.replay_archive(start_ms, end_ms, params.get('node', uid))
+          self.send_rpc_response(uid, request_id, {"status": "ok", "frames": count})
+
+        # reading the archive can take a while, do not block the MQTT network loop
+        thread = Thread(target=replay, name="replay-archive")
+        thread.daemon = True
+        thread.start()
       else:
         self.log.info("RPC method not supported, skipping")
         return
@@ -285,30 +647,62 @@ class Gateway:
 
   def run(self):
     self.log.info("Started")
-    keep_running = True
-    while keep_running:
-      try:
-        if platform.system() == "Windows":
-          time.sleep(1)
-        else:
+    # the main thread only waits for a signal, SIGTERM (from the init script for example) stops the gateway like Ctrl-C
+    signal.signal(signal.SIGTERM, lambda signum, frame: self.stopped.set())
+    try:
+      while not self.stopped.is_set():
+        if hasattr(signal, "pause"):
           signal.pause()
-      except KeyboardInterrupt:
-        self.log.info("received KeyboardInterrupt... stopping processing")
-        if self.thingsboard_enabled:
-          self.tb.disconnect()
-        keep_running = False
-
-      self.report_stats()
+        else:
+          self.stopped.wait(1)
+    except KeyboardInterrupt:
+      self.log.info("received KeyboardInterrupt... stopping processing")
+
+    self.stop()
+
+  def stop(self):
+    # stop the periodic work first, the components flush what is pending themselves when they are stopped
+    self.scheduler.stop()
+    if self.metrics_server is not None:
+      self.metrics_server.stop()
+    self.downlink.stop()
+    for modem in self.modems:
+      modem.stop()
+    self.pipeline.stop()
+    self.plugin_executor.close()
+    if self.system_file_cache is not None:
+      self.system_file_cache.close()
+    self.sinks.stop()
+    self.m.disconnect()
+    if self.aggregator is not None:
+      self.aggregator.stop()
+    if self.thingsboard_enabled:
+      self.tb.disconnect()
 
-  def keep_stats(self):
-    self.bridge_count += 1
+  def report_metrics(self):
+    self.tb.sendGwTelemetry(self.metrics.snapshot())
 
   def report_stats(self):
-    if self.next_report < time.time():
-      if self.bridge_count > 0:
-        self.log.info("bridged %s messages" % str(self.bridge_count))
-        self.bridge_count = 0
-      self.next_report = time.time() + 15  # report at most every 15 seconds
+    forwarded = sum(value for _, _, _, value in self.frames_forwarded.samples())
+    if forwarded > self.forwarded_reported:
+      self.log.info("bridged %s messages" % str(forwarded - self.forwarded_reported))
+      self.forwarded_reported = forwarded
+    for name, stats in sorted(self.pipeline.stats().items()):
+      if stats['depth'] > 0 or stats['dropped'] > 0:
+        self.log.info("pipeline stage {}: {}".format(name, stats))
+    for name, stats in sorted(self.sinks.stats().items()):
+      if stats['depth'] > 0 or stats['dropped'] > 0 or stats['errors'] > 0:
+        self.log.info("sink {}: {}".format(name, stats))
+    if len(self.modems) > 1:
+      for modem in self.modems:
+        self.log.info("modem {}: {}".format(modem.uid, modem.stats()))
+    mqtt_stats = self.m.stats()
+    if mqtt_stats['buffered'] > 0 or mqtt_stats['dropped'] > 0:
+      self.log.info("MQTT: {}".format(mqtt_stats))
+    if self.binary_uplink is not None and self.binary_uplink.blobs > 0:
+      self.log.info("binary uplink: {}".format(self.binary_uplink.stats()))
+    if self.duplicate_filter is not None and self.duplicate_filter.hits > 0:
+      self.log.info("duplicate frames: {}".format(self.duplicate_filter.stats()))
 
   def get_ip(self):
     s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
@@ -323,5 +717,30 @@ class Gateway:
     return IP
 
 
+def git_revision():
+  """ returns the abbreviated commit the gateway runs from, read from the .git directory since running git is slow on a Pi """
+  git_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".git")
+  try:
+    with open(os.path.join(git_dir, "HEAD")) as f:
+      head = f.read().strip()
+
+    if head.startswith("ref: "):
+      ref = head[len("ref: "):]
+      if os.path.exists(os.path.join(git_dir, ref)):
+        with open(os.path.join(git_dir, ref)) as f:
+          head = f.read().strip()
+      else:
+        with open(os.path.join(git_dir, "packed-refs")) as f:
+          refs = dict(reversed(line.split()) for line in f if line.strip() and not line.startswith(("#", "^")))
+        head = refs[ref]
+
+    return head[:7]
+  except (IOError, OSError, KeyError):
+    try:
+      return subprocess.check_output(["git", "describe", "--always"]).strip().decode("utf-8")
+    except (OSError, subprocess.CalledProcessError):
+      return "unknown"
+
+
 if __name__ == "__main__":
   Gateway().run()
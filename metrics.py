@@ -0,0 +1,233 @@
+import logging
+from bisect import bisect_left
+from threading import Lock, Thread
+
+logger = logging.getLogger(__name__)
+
+# latency buckets in seconds, from 100 us up to 10 s
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+def _label_key(labels):
+    return tuple(sorted(labels.items()))
+
+
+def _format_labels(key, extra=None):
+    items = list(key)
+    if extra is not None:
+        items.append(extra)
+
+    if not items:
+        return ""
+
+    return "{" + ",".join('{}="{}"'.format(name, value) for name, value in items) + "}"
+
+
+def _snapshot_key(name, key):
+    return ":".join([name] + [str(value) for _, value in key])
+
+
+class Counter:
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self.type = "counter"
+        self.values = {}
+        self.lock = Lock()
+
+    def inc(self, amount=1, **labels):
+        key = _label_key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def samples(self):
+        with self.lock:
+            return [(self.name, key, None, value) for key, value in self.values.items()]
+
+
+class Gauge:
+    """
+    a value read from a callback when the metrics are collected, the callback returns a value, a dict of labels -> value
+    or None while there is no value yet
+    """
+    def __init__(self, name, help, callback, label=None):
+        self.name = name
+        self.help = help
+        self.type = "gauge"
+        self.callback = callback
+        self.label = label
+
+    def samples(self):
+        value = self.callback()
+        if value is None:
+            return []
+        if isinstance(value, dict):
+            return [(self.name, ((self.label, label_value),), None, v) for label_value, v in value.items()]
+
+        return [(self.name, (), None, value)]
+
+
+class CallbackCounter(Gauge):
+    """ a counter kept by a component, read from a callback like a gauge, the value only increases """
+    def __init__(self, name, help, callback, label=None):
+        Gauge.__init__(self, name, help, callback, label)
+        self.type = "counter"
+
+
+class Histogram:
+    def __init__(self, name, help, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.type = "histogram"
+        self.buckets = buckets
+        self.values = {}  # label key -> [bucket counts..., count, sum]
+        self.lock = Lock()
+
+    def observe(self, value, **labels):
+        key = _label_key(labels)
+        index = bisect_left(self.buckets, value)
+        with self.lock:
+            values = self.values.get(key)
+            if values is None:
+                values = self.values[key] = [0] * (len(self.buckets) + 3)
+
+            values[index] += 1  # index len(buckets) is the +Inf bucket
+            values[-2] += 1
+            values[-1] += value
+
+    def samples(self):
+        samples = []
+        with self.lock:
+            items = [(key, list(values)) for key, values in self.values.items()]
+
+        for key, values in items:
+            cumulative = 0
+            for bound, count in zip(list(self.buckets) + ["+Inf"], values):
+                cumulative += count
+                samples.append((self.name + "_bucket", key, ("le", bound), cumulative))
+
+            samples.append((self.name + "_count", key, None, values[-2]))
+            samples.append((self.name + "_sum", key, None, values[-1]))
+
+        return samples
+
+    def quantile(self, key, fraction):
+        """ estimates a quantile as the upper bound of the bucket containing it """
+        with self.lock:
+            values = list(self.values.get(key, []))
+
+        if not values or values[-2] == 0:
+            return None
+
+        rank = fraction * values[-2]
+        cumulative = 0
+        for bound, count in zip(self.buckets, values):
+            cumulative += count
+            if cumulative >= rank:
+                return bound
+
+        return float("inf")
+
+
+class Registry:
+    def __init__(self, prefix="d7gw_"):
+        self.prefix = prefix
+        self.metrics = []
+
+    def _add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, help, callback=None, label=None):
+        """ a counter incremented with inc(), or read from callback when the component counts itself """
+        if callback is not None:
+            return self._add(CallbackCounter(self.prefix + name, help, callback, label))
+
+        return self._add(Counter(self.prefix + name, help))
+
+    def gauge(self, name, help, callback, label=None):
+        return self._add(Gauge(self.prefix + name, help, callback, label))
+
+    def histogram(self, name, help, buckets=LATENCY_BUCKETS):
+        return self._add(Histogram(self.prefix + name, help, buckets))
+
+    def render(self):
+        """ returns all metrics in the Prometheus text exposition format """
+        lines = []
+        for metric in self.metrics:
+            try:
+                samples = metric.samples()
+            except Exception as e:
+                logger.warning("Could not collect metric {}: {}".format(metric.name, e))
+                continue
+
+            lines.append("# HELP {} {}".format(metric.name, metric.help))
+            lines.append("# TYPE {} {}".format(metric.name, metric.type))
+            for name, key, extra, value in samples:
+                lines.append("{}{} {}".format(name, _format_labels(key, extra), value))
+
+        return "\n".join(lines) + "\n"
+
+    def snapshot(self):
+        """ returns a flat dict of metric values, histograms are summarized as count, average and p99 estimate """
+        values = {}
+        for metric in self.metrics:
+            name = metric.name[len(self.prefix):]
+            if isinstance(metric, Histogram):
+                with metric.lock:
+                    keys = list(metric.values.keys())
+
+                for key in keys:
+                    with metric.lock:
+                        count, total = metric.values[key][-2], metric.values[key][-1]
+
+                    base = _snapshot_key(name, key)
+                    values[base + "_count"] = count
+                    values[base + "_avg"] = total / count if count > 0 else 0
+                    p99 = metric.quantile(key, 0.99)
+                    values[base + "_p99"] = p99 if p99 != float("inf") else None
+            else:
+                try:
+                    samples = metric.samples()
+                except Exception:
+                    continue
+
+                for _, key, _, value in samples:
+                    values[_snapshot_key(name, key)] = value
+
+        return values
+
+
+class MetricsServer:
+    """ serves the metrics of a registry over HTTP, for scraping by Prometheus """
+    def __init__(self, registry, port, host=""):
+        # only imported when the metrics are served, it slows down the start
+        try:
+            from http.server import BaseHTTPRequestHandler, HTTPServer
+        except ImportError:
+            from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+
+        registry_ = registry
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = registry_.render().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = HTTPServer((host, port), Handler)
+        self.thread = Thread(target=self.server.serve_forever, name="metrics-http")
+        self.thread.daemon = True
+
+    def start(self):
+        self.thread.start()
+        logger.info("Serving metrics on port {}".format(self.server.server_address[1]))
+
+    def stop(self):
+        self.server.shutdown()
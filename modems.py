@@ -0,0 +1,163 @@
+import logging
+import sys
+import traceback
+from threading import Thread, Event, Lock
+
+from modem.modem import Modem
+
+logger = logging.getLogger(__name__)
+
+
+def _log_exception(message):
+    exc_type, exc_value, exc_traceback = sys.exc_info()
+    lines = traceback.format_exception(exc_type, exc_value, exc_traceback)
+    logger.error("{}: \n{}".format(message, "".join(lines)))
+
+
+class GatewayModem:
+    """
+    One serial modem served by the gateway. The modem is connected on its own thread, retrying until it succeeds, after
+    which on_connected is called. The thread keeps checking the connection: when the read thread of the modem stops or
+    the serial port is closed (the modem was unplugged or reset) the port is opened again and the modem is reconnected,
+    calling on_connected again. Received commands are passed to receive_callback(gateway_modem, cmd) on the read thread
+    of the modem.
+    """
+    def __init__(self, device, rate, receive_callback, on_connected, binary=False, retry_interval_seconds=1,
+                 check_interval_seconds=5):
+        self.device = device
+        self.rate = rate
+        self.binary = binary
+        self.receive_callback = receive_callback
+        self.on_connected = on_connected
+        self.retry_interval = retry_interval_seconds
+        self.check_interval = check_interval_seconds
+        self.modem = None  # opened on the thread of the GatewayModem, so a missing device is retried as well
+        self.lock = Lock()
+        self.uid = None
+        self.firmware_version = None
+        self.connected = Event()
+        self.stopped = Event()
+        self.thread = None
+        self.received = 0
+        self.connect_attempts = 0
+        self.reconnects = 0
+
+    def start(self):
+        self.thread = Thread(target=self.run, name="modem-{}".format(self.device))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.disconnect()
+        if self.thread is not None:
+            self.thread.join(self.retry_interval + self.check_interval)
+            self.thread = None
+
+    def run(self):
+        while self.connect():
+            while not self.stopped.wait(self.check_interval):
+                if not self.alive():
+                    logger.warning("Lost the connection to modem {} on {}, reconnecting ...".format(self.uid, self.device))
+                    self.reconnects += 1
+                    break
+
+            self.disconnect()
+
+    def connect(self):
+        """ opens and connects the modem, retrying until it succeeds, returns False when stopped before that """
+        while not self.stopped.is_set():
+            self.connect_attempts += 1
+            try:
+                with self.lock:
+                    if self.modem is None:
+                        self.modem = Modem(self.device, self.rate, self.on_command_received, self.binary)
+                    modem = self.modem
+
+                if modem.connect():
+                    break
+            except:
+                _log_exception("Exception while connecting modem {}".format(self.device))
+
+            logger.warning("Not connected to modem {}, retrying ...".format(self.device))
+            # open the serial port again on the next attempt
+            self.disconnect()
+            self.stopped.wait(self.retry_interval)
+        else:
+            return False
+
+        self.uid = modem.uid
+        firmware_version = getattr(modem, "firmware_version", None)
+        self.firmware_version = str(firmware_version) if firmware_version is not None else "unknown"
+        self.connected.set()
+        logger.info("Connected to modem {} on {}".format(self.uid, self.device))
+        try:
+            self.on_connected(self)
+        except:
+            _log_exception("Exception while setting up modem {}".format(self.uid))
+
+        return True
+
+    def alive(self):
+        modem = self.modem
+        if modem is None:
+            return False
+
+        read_thread = getattr(modem, "read_thread", None)
+        if read_thread is not None and not read_thread.is_alive():
+            return False
+
+        dev = getattr(modem, "dev", None)
+        return dev is None or getattr(dev, "is_open", True)
+
+    def disconnect(self):
+        """ stops the read thread of the modem and closes its serial port """
+        with self.lock:
+            modem, self.modem = self.modem, None
+            self.connected.clear()
+
+        if modem is None:
+            return
+
+        try:
+            if getattr(modem, "read_async_active", True) and hasattr(modem, "stop_reading"):
+                modem.stop_reading()
+        except:
+            _log_exception("Exception while stopping the read thread of modem {}".format(self.device))
+
+        dev = getattr(modem, "dev", None)
+        try:
+            if dev is not None:
+                dev.close()
+            elif hasattr(modem, "close"):
+                modem.close()
+        except:
+            _log_exception("Exception while closing modem {}".format(self.device))
+
+    def on_command_received(self, cmd):
+        if self.stopped.is_set():
+            return
+
+        self.received += 1
+        self.receive_callback(self, cmd)
+
+    def current(self):
+        modem = self.modem
+        if modem is None or not self.connected.is_set():
+            raise IOError("Not connected to modem {}".format(self.uid or self.device))
+
+        return modem
+
+    def execute_command(self, cmd, timeout_seconds=1):
+        return self.current().execute_command(cmd, timeout_seconds=timeout_seconds)
+
+    def execute_command_async(self, cmd):
+        return self.current().execute_command_async(cmd)
+
+    def stats(self):
+        return {
+            'device': self.device,
+            'connected': self.connected.is_set(),
+            'received': self.received,
+            'reconnects': self.reconnects
+        }
@@ -1,50 +1,214 @@
 import logging
+from collections import deque
+from threading import Lock
+
 import paho.mqtt.client as mqtt
 
+from mqtt_connection import MqttConnection
+from scheduler import shared_scheduler
+
 logger = logging.getLogger(__name__)
 
 class Mqtt:
-    def __init__(self, broker, port = 1883, subscription_topic=None, mqtt_callback=None):
+    """
+    Publishes messages to a broker through a bounded buffer. Messages are sent while connected, with at most max_inflight
+    messages not yet acknowledged by the broker (or, for QoS 0, not yet written to the socket). Messages in flight when the
+    connection is lost are sent again after reconnecting, so delivery is at least once: QoS 0 messages are buffered again,
+    QoS 1 and 2 messages are resent by paho itself and stay in flight until the broker acknowledges them. When the buffer
+    is full the oldest message is dropped.
+    """
+    def __init__(self, broker, port = 1883, subscription_topic=None, mqtt_callback=None, qos=0, buffer_size=10000, max_inflight=20):
         self.broker = broker
         self.port = port
         self.mqtt_callback = mqtt_callback
         self.connected_to_mqtt = False
         self.subscription_topic = subscription_topic
-        try:
-            self.connect_mqtt()
-        except:
-            logger.warning("Can't connect to MQTT broker")
+        self.qos = qos
+        self.buffer_size = buffer_size
+        self.max_inflight = max_inflight
+        self.buffer = deque()  # (topic, message) waiting to be published
+        self.inflight = {}  # mid -> (topic, message)
+        self.early_acks = set()  # mids acknowledged before publish() returned
+        self.draining = False
+        self.lock = Lock()
+        self.published = 0
+        self.dropped = 0
+        self.connect_mqtt()
 
     def connect_mqtt(self):
         self.mq = mqtt.Client()
         self.mq.on_connect = self.on_mqtt_connect
         self.mq.on_disconnect = self.on_mqtt_disconnect
-        try:
-            self.mq.connect(self.broker, self.port)
-            if self.subscription_topic is not None and self.mqtt_callback is not None:
-                self.mq.on_message = self.on_mqtt_message
-                self.mq.subscribe(self.subscription_topic, qos=1)
-            self.mq.loop_start()
-            while not self.connected_to_mqtt: pass  # busy wait until connected
-        except:
-            logger.warning("Failed to connect MQTT broker")
-            self.connected_to_mqtt = False
-            raise
+        self.mq.on_publish = self.on_mqtt_publish
+        if self.subscription_topic is not None and self.mqtt_callback is not None:
+            self.mq.on_message = self.on_mqtt_message
+
+        # connects in the background and reconnects with exponential backoff
+        self.connection = MqttConnection(self.mq, self.broker, self.port, name="mqtt")
+        self.connection.start()
 
     def on_mqtt_connect(self, client, userdata, flags_dict, rc):
+        if rc != mqtt.MQTT_ERR_SUCCESS:
+            return
+
         self.connected_to_mqtt = True
         logger.info("Connected to MQTT broker at %s", self.broker)
+        if self.subscription_topic is not None and self.mqtt_callback is not None:
+            self.mq.subscribe(self.subscription_topic, qos=1)
+
+        if self.buffer:
+            logger.info("Publishing {} buffered messages".format(len(self.buffer)))
+            self.drain()
 
     def on_mqtt_disconnect(self, client, userdata, rc):
         self.connected_to_mqtt = False
-        logger.warning("MQTT broker disconnected")
+        with self.lock:
+            # paho resends unacknowledged QoS 1 and 2 messages after reconnecting, under the same mid, buffering them
+            # again would deliver them twice
+            if self.qos == 0:
+                # messages which were not written are sent again after reconnecting, in their original order
+                for mid in sorted(self.inflight.keys(), reverse=True):
+                    self.buffer.appendleft(self.inflight[mid])
+
+                self.inflight.clear()
+                self.early_acks.clear()
+
+        logger.warning("MQTT broker disconnected, {} messages buffered".format(len(self.buffer)))
+
+    def on_mqtt_publish(self, client, userdata, mid):
+        with self.lock:
+            if self.inflight.pop(mid, None) is None:
+                self.early_acks.add(mid)
+            else:
+                self.published += 1
+
+        self.drain()
 
     def on_mqtt_message(self, client, config, msg):
         self.mqtt_callback(client, config, msg)
 
     def publish_message(self, topic, message):
-        self.mq.publish(topic, message)
+        with self.lock:
+            if len(self.buffer) >= self.buffer_size:
+                self.buffer.popleft()
+                self.dropped += 1
+
+            self.buffer.append((topic, message))
+
+        self.drain()
+
+    def drain(self):
+        """ publishes buffered messages until the in-flight window is full, only one thread drains at a time """
+        with self.lock:
+            if self.draining:
+                return
+
+            self.draining = True
+
+        while True:
+            with self.lock:
+                if not self.connected_to_mqtt or not self.buffer or len(self.inflight) >= self.max_inflight:
+                    self.draining = False
+                    return
+
+                topic, message = self.buffer.popleft()
+
+            # the lock is not held while publishing, paho can call on_publish before publish() returns
+            try:
+                info = self.mq.publish(topic, message, qos=self.qos)
+            except Exception as e:
+                logger.warning("Could not publish to MQTT broker: {}".format(e))
+                info = None
+
+            with self.lock:
+                # when the connection was lost meanwhile the message is sent again after reconnecting, by paho when it
+                # accepted a QoS 1 or 2 message
+                if info is None or info.rc not in (mqtt.MQTT_ERR_SUCCESS, mqtt.MQTT_ERR_NO_CONN) or \
+                        (self.qos == 0 and (info.rc != mqtt.MQTT_ERR_SUCCESS or not self.connected_to_mqtt)):
+                    self.buffer.appendleft((topic, message))
+                    self.draining = False
+                    return
+
+                if info.mid in self.early_acks:
+                    self.early_acks.discard(info.mid)
+                    self.published += 1
+                else:
+                    self.inflight[info.mid] = (topic, message)
+
+                if info.rc != mqtt.MQTT_ERR_SUCCESS:
+                    self.draining = False
+                    return
+
+    def stats(self):
+        return {
+            'connected': self.connected_to_mqtt,
+            'buffered': len(self.buffer),
+            'inflight': len(self.inflight),
+            'published': self.published,
+            'dropped': self.dropped
+        }
 
     def disconnect(self):
-        self.mq.loop_stop()
-        self.mq.disconnect()
+        self.connection.stop()
+
+
+class RawForwarder:
+    """
+    Forwards raw ALP commands, hex encoded, to the MQTT broker on topic "<prefix>/<node_id>/<gateway_id>". In aggregation mode
+    the commands received during aggregate_interval seconds are published together on topic "<prefix>/<gateway_id>", one
+    command per line as "<node_id>,<timestamp in ms>,<hex ALP command>".
+    """
+    def __init__(self, mqtt_client, topic_prefix, aggregate_interval_seconds=0, aggregate_max_frames=100, scheduler=None):
+        self.mqtt = mqtt_client
+        self.scheduler = scheduler if scheduler is not None else shared_scheduler()
+        self.topic_prefix = topic_prefix
+        self.aggregate_interval = aggregate_interval_seconds
+        self.aggregate_max_frames = aggregate_max_frames
+        self.topics = {}  # (node_id, gateway_id) -> topic, node_id is None for the aggregated topics
+        self.aggregated = {}  # gateway_id -> list of lines
+        self.timer = None
+        self.lock = Lock()
+
+    def topic(self, node_id, gateway_id):
+        key = (node_id, gateway_id)
+        topic = self.topics.get(key)
+        if topic is None:
+            topic = self.topics[key] = "{}/{}/{}".format(self.topic_prefix, node_id, gateway_id)
+
+        return topic
+
+    def forward(self, node_id, gateway_id, timestamp, message):
+        if self.aggregate_interval <= 0:
+            self.mqtt.publish_message(self.topic(node_id, gateway_id), message)
+            return
+
+        flush = None
+        with self.lock:
+            lines = self.aggregated.setdefault(gateway_id, [])
+            lines.append(b",".join([node_id.encode("utf-8"), str(timestamp).encode("utf-8"), bytes(message)]))
+            if len(lines) >= self.aggregate_max_frames:
+                flush = self.aggregated.pop(gateway_id)
+            elif self.timer is None:
+                self.timer = self.scheduler.call_later(self.aggregate_interval, self.flush, "mqtt-aggregate")
+
+        if flush is not None:
+            self.publish_aggregated(gateway_id, flush)
+
+    def flush(self):
+        with self.lock:
+            aggregated = self.aggregated
+            self.aggregated = {}
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+
+        for gateway_id, lines in aggregated.items():
+            self.publish_aggregated(gateway_id, lines)
+
+    def publish_aggregated(self, gateway_id, lines):
+        key = (None, gateway_id)
+        topic = self.topics.get(key)
+        if topic is None:
+            topic = self.topics[key] = "{}/{}".format(self.topic_prefix, gateway_id)
+
+        self.mqtt.publish_message(topic, b"\n".join(lines))
@@ -0,0 +1,113 @@
+import logging
+import random
+import time
+from threading import Thread, Event
+
+import paho.mqtt.client as mqtt
+
+logger = logging.getLogger(__name__)
+
+
+class Backoff:
+    """ exponential backoff with jitter: each delay is randomized between half and the full exponential delay """
+    def __init__(self, initial_seconds=1, max_seconds=120, factor=2):
+        self.initial = initial_seconds
+        self.max = max_seconds
+        self.factor = factor
+        self.attempts = 0
+
+    def next(self):
+        delay = min(self.max, self.initial * self.factor ** self.attempts)
+        self.attempts += 1
+        return delay / 2.0 + random.uniform(0, delay / 2.0)
+
+    def reset(self):
+        self.attempts = 0
+
+
+class MqttConnection:
+    """
+    Keeps a paho client connected to a broker. Connecting, running the network loop and reconnecting all happen on a
+    background thread, so start() returns immediately. Waiting is done on events, so no CPU is used while the broker
+    is unreachable. When no CONNACK is received within connect_timeout seconds the attempt is aborted.
+    The on_connect and on_disconnect callbacks of the client are wrapped, they are still called.
+    """
+    def __init__(self, client, host, port=1883, keepalive=60, connect_timeout=10, backoff=None, name="mqtt"):
+        self.client = client
+        self.host = host
+        self.port = port
+        self.keepalive = keepalive
+        self.connect_timeout = connect_timeout
+        self.backoff = backoff if backoff is not None else Backoff()
+        self.name = name
+        self.connected = Event()
+        self.stopped = Event()
+        self.thread = None
+        self.reconnects = 0
+        self.accepted = False  # the broker accepted the current connection attempt
+
+        self.on_connect = client.on_connect
+        self.on_disconnect = client.on_disconnect
+        client.on_connect = self._on_connect
+        client.on_disconnect = self._on_disconnect
+
+    def start(self):
+        self.thread = Thread(target=self._run, name=self.name)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        if self.connected.is_set():
+            self.client.disconnect()
+
+        if self.thread is not None:
+            self.thread.join(self.connect_timeout)
+
+    def wait_connected(self, timeout=None):
+        return self.connected.wait(timeout)
+
+    def _on_connect(self, client, userdata, flags_dict, rc):
+        if rc == mqtt.MQTT_ERR_SUCCESS:
+            self.accepted = True
+            self.connected.set()
+            self.backoff.reset()
+        else:
+            logger.warning("Connection to MQTT broker {} refused (rc {})".format(self.host, rc))
+
+        if self.on_connect is not None:
+            self.on_connect(client, userdata, flags_dict, rc)
+
+    def _on_disconnect(self, client, userdata, rc):
+        was_connected = self.connected.is_set()
+        self.connected.clear()
+        if was_connected and self.on_disconnect is not None:
+            self.on_disconnect(client, userdata, rc)
+
+    def _run(self):
+        while not self.stopped.is_set():
+            self.accepted = False
+            try:
+                self.client.connect(self.host, self.port, keepalive=self.keepalive)
+            except Exception as e:
+                delay = self.backoff.next()
+                logger.debug("Could not connect to MQTT broker {}: {}, retrying in {:.1f} s".format(self.host, e, delay))
+                self.stopped.wait(delay)
+                continue
+
+            deadline = time.time() + self.connect_timeout
+            while not self.stopped.is_set():
+                if self.client.loop(timeout=1.0) != mqtt.MQTT_ERR_SUCCESS:
+                    break
+
+                if not self.connected.is_set() and time.time() > deadline:
+                    logger.warning("No response from MQTT broker {} within {} s".format(self.host, self.connect_timeout))
+                    self.client.disconnect()
+                    deadline = float("inf")
+
+            self._on_disconnect(self.client, None, mqtt.MQTT_ERR_CONN_LOST)
+            if not self.stopped.is_set():
+                # attempts which timed out before the broker accepted them are not reconnects of a lost connection
+                if self.accepted:
+                    self.reconnects += 1
+                self.stopped.wait(self.backoff.next())
@@ -0,0 +1,109 @@
+import logging
+import os
+import sqlite3
+from threading import Lock
+
+logger = logging.getLogger(__name__)
+
+EVICT_DROP_OLDEST = "drop-oldest"
+EVICT_PRIORITY = "priority"
+EVICTION_POLICIES = [EVICT_DROP_OLDEST, EVICT_PRIORITY]
+
+
+class OfflineQueue:
+    """
+    Bounded, disk backed FIFO of (topic, payload) messages stored in a SQLite database in WAL mode.
+    Messages stay on disk until they are acknowledged, so the queue survives a restart of the gateway.
+    When the queue exceeds max_messages or max_bytes messages are evicted, either the oldest ones
+    (drop-oldest) or the oldest ones of the lowest priority (priority). Lower numbers are more important, like the
+    PRIORITY_* constants of thingsboard.py, so the messages with the highest number are evicted first.
+    """
+    def __init__(self, path, max_messages=100000, max_bytes=50 * 1024 * 1024, eviction=EVICT_DROP_OLDEST):
+        if eviction not in EVICTION_POLICIES:
+            raise ValueError("unknown eviction policy {}".format(eviction))
+
+        self.path = path
+        self.max_messages = max_messages
+        self.max_bytes = max_bytes
+        self.eviction = eviction
+        self.evicted = 0
+        self.lock = Lock()
+
+        directory = os.path.dirname(path)
+        if directory != "" and not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        self.db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS messages ("
+                        "id INTEGER PRIMARY KEY AUTOINCREMENT, "
+                        "priority INTEGER NOT NULL, "
+                        "topic TEXT NOT NULL, "
+                        "payload BLOB NOT NULL)")
+        # the eviction order, least important and then oldest first
+        self.db.execute("DROP INDEX IF EXISTS messages_priority")
+        self.db.execute("CREATE INDEX IF NOT EXISTS messages_eviction ON messages (priority DESC, id)")
+
+        # keep the totals in memory so put() does not need to query the database
+        self.count, self.bytes = self.db.execute("SELECT COUNT(*), IFNULL(SUM(LENGTH(payload)), 0) FROM messages").fetchone()
+        if self.count > 0:
+            logger.info("Offline queue {} contains {} messages ({} bytes)".format(path, self.count, self.bytes))
+
+    def __len__(self):
+        return self.count
+
+    def put(self, topic, payload, priority=0):
+        if not isinstance(payload, bytes):
+            payload = payload.encode("utf-8")
+
+        with self.lock:
+            self.db.execute("INSERT INTO messages (priority, topic, payload) VALUES (?, ?, ?)",
+                            (priority, topic, sqlite3.Binary(payload)))
+            self.count += 1
+            self.bytes += len(payload)
+            self._evict()
+
+    def peek(self, limit):
+        """ returns the oldest messages as a list of (id, topic, payload) without removing them """
+        with self.lock:
+            rows = self.db.execute("SELECT id, topic, payload FROM messages ORDER BY id LIMIT ?", (limit,)).fetchall()
+
+        return [(id, topic, bytes(payload)) for id, topic, payload in rows]
+
+    def ack(self, id):
+        """ removes a message after it has been delivered """
+        with self.lock:
+            self._delete(id)
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+    def _delete(self, id):
+        row = self.db.execute("SELECT LENGTH(payload) FROM messages WHERE id = ?", (id,)).fetchone()
+        if row is None:
+            return False  # already evicted or acknowledged
+
+        self.db.execute("DELETE FROM messages WHERE id = ?", (id,))
+        self.count -= 1
+        self.bytes -= row[0]
+        return True
+
+    def _evict(self):
+        if self.count <= self.max_messages and self.bytes <= self.max_bytes:
+            return
+
+        if self.eviction == EVICT_PRIORITY:
+            order = "priority DESC, id"
+        else:
+            order = "id"
+
+        evicted = 0
+        while self.count > 0 and (self.count > self.max_messages or self.bytes > self.max_bytes):
+            id = self.db.execute("SELECT id FROM messages ORDER BY {} LIMIT 1".format(order)).fetchone()[0]
+            self._delete(id)
+            evicted += 1
+
+        self.evicted += evicted
+        logger.warning("Offline queue full, evicted {} messages ({})".format(evicted, self.eviction))
@@ -0,0 +1,192 @@
+import logging
+import os
+import pickle
+import sys
+import time
+import traceback
+from threading import Thread, Lock
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+from offline_queue import OfflineQueue
+
+logger = logging.getLogger(__name__)
+
+OVERFLOW_BLOCK = "block"
+OVERFLOW_DROP_OLDEST = "drop-oldest"
+OVERFLOW_SPILL = "spill"
+OVERFLOW_POLICIES = [OVERFLOW_BLOCK, OVERFLOW_DROP_OLDEST, OVERFLOW_SPILL]
+
+
+class Stage:
+    """
+    A processing step with a bounded input queue served by a number of worker threads. The handler is called for every
+    item and its return value (unless None) is passed to the next stage. When the queue is full the overflow policy
+    decides what happens: block the producer, drop the oldest queued item or spill the item to disk (spilled items
+    are processed again when there is room in the queue).
+    """
+    def __init__(self, name, handler, workers=1, max_size=1000, overflow=OVERFLOW_BLOCK, spill_dir=""):
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError("unknown overflow policy {}".format(overflow))
+
+        self.name = name
+        self.handler = handler
+        self.workers = workers
+        self.max_size = max_size
+        self.overflow = overflow
+        self.next = None
+        self.queue = queue.Queue(max_size)
+        self.lock = Lock()
+        self.threads = []
+        self.processed = 0
+        self.dropped = 0
+        self.spilled = 0
+        self.errors = 0
+        self.duration = None  # optional histogram of the handler duration
+        self.spill_queue = None
+        if overflow == OVERFLOW_SPILL:
+            self.spill_queue = OfflineQueue(os.path.join(spill_dir, "spill-{}.db".format(name)))
+
+    def start(self):
+        for i in range(self.workers):
+            thread = Thread(target=self.work, name="{}-{}".format(self.name, i))
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+        # items spilled before a restart, the workers pick up the rest of the backlog as they process these
+        if self.spill_queue is not None and len(self.spill_queue) > 0:
+            self.unspill()
+
+    def stop(self):
+        for thread in self.threads:
+            self.queue.put(None)
+
+        for thread in self.threads:
+            thread.join()
+
+        self.threads = []
+        if self.spill_queue is not None:
+            self.spill_queue.close()
+
+    def put(self, item):
+        if self.overflow == OVERFLOW_BLOCK:
+            self.queue.put(item)
+            return
+
+        if self.spill_queue is not None and len(self.spill_queue) > 0:
+            # keep the order, items arriving after a spill are spilled as well until the backlog is processed
+            self.spill(item)
+            self.unspill()
+            return
+
+        try:
+            self.queue.put_nowait(item)
+        except queue.Full:
+            if self.overflow == OVERFLOW_SPILL:
+                self.spill(item)
+                return
+
+            with self.lock:
+                try:
+                    self.queue.get_nowait()
+                    self.dropped += 1
+                except queue.Empty:
+                    pass
+
+                try:
+                    self.queue.put_nowait(item)
+                except queue.Full:
+                    self.dropped += 1
+
+    def spill(self, item):
+        self.spill_queue.put(self.name, pickle.dumps(item, pickle.HIGHEST_PROTOCOL))
+        self.spilled += 1
+
+    def unspill(self):
+        free = self.max_size - self.queue.qsize()
+        if free <= 0:
+            return
+
+        with self.lock:
+            for id, name, payload in self.spill_queue.peek(free):
+                try:
+                    self.queue.put_nowait(pickle.loads(payload))
+                except queue.Full:
+                    break
+
+                self.spill_queue.ack(id)
+
+    def work(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+
+            start = time.time()
+            try:
+                result = self.handler(item)
+                if result is not None and self.next is not None:
+                    self.next.put(result)
+            except:
+                self.errors += 1
+                exc_type, exc_value, exc_traceback = sys.exc_info()
+                lines = traceback.format_exception(exc_type, exc_value, exc_traceback)
+                logger.error("Exception in stage {}: \n{}".format(self.name, "".join(lines)))
+
+            self.processed += 1
+            if self.duration is not None:
+                self.duration.observe(time.time() - start, stage=self.name)
+
+            if self.spill_queue is not None and len(self.spill_queue) > 0:
+                self.unspill()
+
+    def stats(self):
+        stats = {
+            'depth': self.queue.qsize(),
+            'processed': self.processed,
+            'dropped': self.dropped,
+            'errors': self.errors
+        }
+        if self.spill_queue is not None:
+            stats['spilled'] = self.spilled
+            stats['spill_depth'] = len(self.spill_queue)
+
+        return stats
+
+
+class Pipeline:
+    """ chains stages so the output of one stage is queued on the next one """
+    def __init__(self, stages):
+        self.stages = stages
+        for stage, next_stage in zip(stages, stages[1:]):
+            stage.next = next_stage
+
+    def start(self):
+        for stage in self.stages:
+            stage.start()
+
+    def stop(self):
+        # stop in order so items in flight can still be passed to the next stages
+        for stage in self.stages:
+            stage.stop()
+
+    def put(self, item):
+        self.stages[0].put(item)
+
+    def stats(self):
+        return dict((stage.name, stage.stats()) for stage in self.stages)
+
+    def instrument(self, metrics):
+        duration = metrics.histogram("stage_seconds", "Time spent processing an item per pipeline stage")
+        for stage in self.stages:
+            stage.duration = duration
+
+        metrics.gauge("stage_depth", "Pipeline stage depth",
+                      lambda: dict((stage.name, stage.stats()["depth"]) for stage in self.stages), label="stage")
+        for name in ["processed", "dropped", "errors"]:
+            metrics.counter("stage_{}_total".format(name), "Pipeline stage {}".format(name),
+                            lambda name=name: dict((stage.name, stage.stats()[name]) for stage in self.stages), label="stage")
@@ -1,17 +1,23 @@
-from bitstring import ConstBitStream
+import struct
+
 from yapsy.IPlugin import IPlugin
 
-from gateway import DataPointType
+from datapoint import DataPointType
 
 
 class ParseSensorFilePlugin(IPlugin):
+  # the file IDs this plugin can parse, the gateway only calls parse_file_data() for these files.
+  # Can also be a dict mapping the file ID to an (offset, length) tuple to only receive data overlapping that range.
+  file_ids = [64]
+
+  sensor_value_struct = struct.Struct(">H")
+
   def parse_file_data(self, file_offset, length, data):
     # filter on the file ID for instance
     if file_offset.id == 64:
         # parse the data, in this example we are assuming the file data contains a temperature value in decicelsius
         # stored as int16, as transmitted by the sensor examples of OSS-7
-        s = ConstBitStream(bytes=bytearray(data))
-        sensor_value = s.read("uintbe:16") / 10.0
+        sensor_value = self.sensor_value_struct.unpack_from(bytearray(data))[0] / 10.0
         yield 'temperature', sensor_value, DataPointType.telemetry
         # note this is a generator function, so multiple values can be returned
 
@@ -0,0 +1,253 @@
+import logging
+import multiprocessing
+import sys
+import time
+import traceback
+from multiprocessing import TimeoutError
+from multiprocessing.pool import ThreadPool
+from threading import Condition
+
+logger = logging.getLogger(__name__)
+
+EXECUTION_INLINE = "inline"
+EXECUTION_THREAD = "thread"
+EXECUTION_PROCESS = "process"
+EXECUTION_MODES = [EXECUTION_INLINE, EXECUTION_THREAD, EXECUTION_PROCESS]
+
+# plugins by name, worker processes inherit them when they are forked or load them again using the loader, so plugins
+# never have to be pickled
+_plugins = {}
+
+
+def _load(loader):
+    # initializer of the worker processes started by the fork server
+    function, args = loader
+    _plugins.update(function(*args))
+
+
+def _parse(name, file_offset, length, data):
+    # runs in the pool, exceptions are returned instead of raised since python 2 pools have no error callback
+    try:
+        return True, list(_plugins[name].parse_file_data(file_offset, length, data))
+    except Exception:
+        return False, "".join(traceback.format_exception(*sys.exc_info()))
+
+
+class PluginTimeout(Exception):
+    pass
+
+
+class PluginError(Exception):
+    pass
+
+
+class CircuitBreaker:
+    """ opens after threshold consecutive failures, after reset_seconds one call is let through to test the plugin again """
+    def __init__(self, threshold, reset_seconds):
+        self.threshold = threshold
+        self.reset = reset_seconds
+        self.failures = 0
+        self.opened_at = None
+
+    @property
+    def open(self):
+        return self.opened_at is not None
+
+    def allow(self, now):
+        if self.opened_at is None:
+            return True
+
+        if now - self.opened_at >= self.reset:
+            self.opened_at = now  # half open, the next call closes or opens the breaker again
+            return True
+
+        return False
+
+    def success(self):
+        self.failures = 0
+        self.opened_at = None
+
+    def failure(self, now):
+        """ returns True when the breaker opens """
+        self.failures += 1
+        if self.failures >= self.threshold:
+            opened = self.opened_at is None
+            self.opened_at = now
+            return opened
+
+        return False
+
+
+class _Task:
+    __slots__ = ["generation", "timed_out", "finished"]
+
+    def __init__(self, generation):
+        self.generation = generation
+        self.timed_out = False
+        self.finished = False
+
+
+class PluginExecutor:
+    """
+    Runs the parse_file_data method of plugins, inline or in a pool of threads or processes. In a pool at most workers
+    plugins run at the same time, a plugin which does not return within its timeout (the timeout attribute of the plugin,
+    or timeout_seconds) raises PluginTimeout in the caller. A plugin which fails or times out failure_threshold times in a
+    row is disabled for reset_seconds. When all workers are occupied by plugins which timed out the pool is replaced; hung
+    processes are terminated, hung threads can only be abandoned.
+    The process pool is forked when start() is called, so start() must be called after all plugins are added and before
+    any thread is started. When a loader is given, a (function, arguments) tuple returning the (name, plugin) tuples,
+    a pool replacing a hung pool is started by a fork server (python 3) and its workers load the plugins themselves,
+    since forking the gateway while its threads run can deadlock the workers.
+    """
+    def __init__(self, mode=EXECUTION_INLINE, workers=2, timeout_seconds=5, failure_threshold=5, reset_seconds=300,
+                 loader=None):
+        if mode not in EXECUTION_MODES:
+            raise ValueError("unknown plugin execution mode {}".format(mode))
+
+        self.mode = mode
+        self.workers = workers
+        self.timeout = timeout_seconds
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.loader = loader
+        self.context = None
+        if mode == EXECUTION_PROCESS and loader is not None and hasattr(multiprocessing, "get_context"):
+            try:
+                self.context = multiprocessing.get_context("forkserver")
+            except ValueError:
+                self.context = None  # no fork server on this platform
+        self.breakers = {}  # plugin name -> CircuitBreaker
+        self.pool = None
+        self.generation = 0
+        self.running = 0
+        self.hung = 0
+        self.condition = Condition()
+        self.timeouts = None
+
+    def instrument(self, metrics):
+        self.timeouts = metrics.counter("plugin_timeouts_total", "Plugins which did not return within their timeout")
+        metrics.gauge("plugin_disabled", "Plugins disabled after repeated failures",
+                      lambda: dict((name, int(breaker.open)) for name, breaker in self.breakers.items()), label="plugin")
+        metrics.gauge("plugin_tasks_running", "Plugins running in the pool", lambda: self.running)
+
+    def add_plugin(self, name, plugin):
+        _plugins[name] = plugin
+        self.breakers[name] = CircuitBreaker(self.failure_threshold, self.reset_seconds)
+
+    def start(self):
+        if self.mode != EXECUTION_INLINE:
+            self.pool = self.create_pool(forked=True)
+
+    def create_pool(self, forked=False):
+        if self.mode == EXECUTION_PROCESS:
+            if not forked and self.context is not None:
+                return self.context.Pool(self.workers, initializer=_load, initargs=(self.loader,))
+            return multiprocessing.Pool(self.workers)
+
+        return ThreadPool(self.workers)
+
+    def close(self):
+        if self.pool is not None:
+            self.stop_pool(self.pool)
+            self.pool = None
+
+    def stop_pool(self, pool):
+        # threads cannot be stopped, terminating a thread pool would wait for hung threads
+        if self.mode == EXECUTION_PROCESS:
+            pool.terminate()
+        else:
+            pool.close()
+
+    def parse(self, name, plugin, file_offset, length, data):
+        """ returns the (name, value, datapoint type) tuples parsed by the plugin, or nothing when the plugin is disabled """
+        breaker = self.breakers.get(name)
+        if breaker is None:
+            breaker = self.breakers[name] = CircuitBreaker(self.failure_threshold, self.reset_seconds)
+
+        with self.condition:
+            if not breaker.allow(time.time()):
+                return []
+
+        try:
+            if self.pool is None:
+                values = list(plugin.parse_file_data(file_offset, length, data))
+            else:
+                values = self.run(name, getattr(plugin, "timeout", self.timeout), file_offset, length, data)
+        except Exception as e:
+            with self.condition:
+                opened = breaker.failure(time.time())
+
+            if isinstance(e, PluginTimeout) and self.timeouts is not None:
+                self.timeouts.inc(plugin=name)
+            if opened:
+                logger.error("Plugin '{}' failed {} times in a row, disabling it for {} s".format(
+                    name, breaker.failures, self.reset_seconds))
+            raise
+
+        with self.condition:
+            breaker.success()
+
+        return values
+
+    def run(self, name, timeout, file_offset, length, data):
+        deadline = time.time() + timeout
+        with self.condition:
+            while self.running >= self.workers:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise PluginTimeout("no worker available for plugin '{}' within {} s".format(name, timeout))
+
+                self.condition.wait(remaining)
+
+            self.running += 1
+            task = _Task(self.generation)
+            pool = self.pool
+
+        try:
+            result = pool.apply_async(_parse, (name, file_offset, length, data), callback=lambda result: self.done(task))
+            ok, values = result.get(max(0, deadline - time.time()))
+        except TimeoutError:
+            with self.condition:
+                recycle = False
+                if not task.finished:
+                    task.timed_out = True
+                    self.hung += 1
+                    recycle = task.generation == self.generation and self.hung >= self.workers
+
+            if recycle:
+                self.recycle()
+            raise PluginTimeout("plugin '{}' did not return within {} s".format(name, timeout))
+        except Exception as e:
+            # the result could not be passed back (not picklable) or the worker failed, the callback is never called
+            self.done(task)
+            raise PluginError("plugin '{}' failed in the pool: {!r}".format(name, e))
+
+        if not ok:
+            raise PluginError(values)
+
+        return values
+
+    def done(self, task):
+        with self.condition:
+            if task.finished:
+                return
+
+            task.finished = True
+            if task.generation == self.generation:
+                self.running -= 1
+                if task.timed_out:
+                    self.hung -= 1
+
+            self.condition.notify()
+
+    def recycle(self):
+        logger.warning("All plugin workers are blocked by plugins which timed out, replacing the pool")
+        with self.condition:
+            pool = self.pool
+            self.pool = self.create_pool()
+            self.generation += 1
+            self.running = 0
+            self.hung = 0
+            self.condition.notify_all()
+
+        self.stop_pool(pool)
@@ -0,0 +1,59 @@
+import logging
+
+from alp_util import length_value
+
+logger = logging.getLogger(__name__)
+
+
+def find_plugins(plugin_path):
+    """ returns (name, plugin) tuples of the yapsy plugins and the parser definitions found in plugin_path """
+    # yapsy is only imported when plugins are used, it slows down the start
+    from yapsy.PluginManager import PluginManagerSingleton
+    from file_parsers import load_parsers
+
+    manager = PluginManagerSingleton.get()
+    manager.setPluginPlaces([plugin_path])
+    manager.collectPlugins()
+    plugins = [(plugin.name, plugin.plugin_object) for plugin in manager.getAllPlugins()]
+    return plugins + [(parser.name, parser) for parser in load_parsers(plugin_path)]
+
+
+class PluginRouter:
+    """
+    Routes file data to the plugins which can parse it. Plugins declare the files they handle using a file_ids attribute,
+    either a list of file IDs or a dict mapping a file ID to None (whole file) or to an (offset, length) tuple, in which
+    case the plugin is only called when the received data overlaps that range. Plugins without file_ids are called for
+    all files, like before.
+    """
+    def __init__(self):
+        self.routes = {}  # file ID -> list of ((name, plugin), range)
+        self.fallback = []  # (name, plugin) of plugins without file_ids declaration
+        self.table = {}  # file ID -> routed and fallback plugins, rebuilt when a plugin is added
+
+    def add_plugin(self, name, plugin):
+        file_ids = getattr(plugin, "file_ids", None)
+        if file_ids is None:
+            logger.info("Plugin '{}' does not declare file_ids, it will be called for all files".format(name))
+            self.fallback.append((name, plugin))
+        else:
+            if not isinstance(file_ids, dict):
+                file_ids = dict((file_id, None) for file_id in file_ids)
+
+            for file_id, file_range in file_ids.items():
+                self.routes.setdefault(file_id, []).append(((name, plugin), file_range))
+
+            logger.info("Plugin '{}' handles files {}".format(name, sorted(file_ids.keys())))
+
+        self.table = dict((file_id, routes + [(plugin, None) for plugin in self.fallback])
+                          for file_id, routes in self.routes.items())
+
+    def plugins_for(self, file_offset, length):
+        """ returns (name, plugin) tuples of the plugins which handle the data """
+        routes = self.table.get(file_offset.id)
+        if routes is None:
+            return self.fallback
+
+        start = length_value(file_offset.offset)
+        end = start + length_value(length)
+        return [plugin for plugin, file_range in routes
+                if file_range is None or (start < file_range[0] + file_range[1] and file_range[0] < end)]
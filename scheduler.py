@@ -0,0 +1,176 @@
+import heapq
+import logging
+import sys
+import time
+import traceback
+from threading import Condition, Thread, Lock
+
+logger = logging.getLogger(__name__)
+
+# a monotonic clock, so jobs are not shifted when the system time is set (by NTP after booting a Pi for example)
+clock = getattr(time, "monotonic", time.time)
+
+
+class Job:
+    """ a callback scheduled on a Scheduler, cancel() prevents it from running again """
+    __slots__ = ["scheduler", "callback", "interval", "name", "due", "cancelled"]
+
+    def __init__(self, scheduler, callback, interval, name, due):
+        self.scheduler = scheduler
+        self.callback = callback
+        self.interval = interval  # None for a job which runs once
+        self.name = name or getattr(callback, "__name__", "job")
+        self.due = due  # None once a job which runs once has run
+        self.cancelled = False
+
+    def cancel(self):
+        self.scheduler.cancel(self)
+
+
+class Scheduler:
+    """
+    Runs the periodic and delayed work of the gateway (heartbeats, flushing batches, reporting stats, ...) on a single
+    thread, from a heap ordered on the time the jobs are due. The thread only wakes up when a job is due. Periodic jobs
+    are scheduled relative to their previous due time, so they do not drift; a job which falls more than one interval
+    behind skips the missed runs. Jobs should not block, a slow job delays the jobs due after it.
+    """
+    def __init__(self, name="scheduler"):
+        self.name = name
+        self.heap = []  # (due, sequence number, job)
+        self.sequence = 0
+        self.condition = Condition()
+        self.stopped = False
+        self.thread = None
+        self.cancelled = 0  # cancelled jobs still in the heap
+        self.runs = 0
+        self.errors = 0
+        self.lateness = None  # optional histogram of the time jobs ran after they were due
+
+    def instrument(self, metrics):
+        self.lateness = metrics.histogram("scheduler_lateness_seconds", "Time jobs ran after they were due")
+        metrics.gauge("scheduler_jobs", "Jobs scheduled", lambda: len(self.heap))
+
+    def start(self):
+        self.thread = Thread(target=self.run, name=self.name)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        """ stops the thread after the job it is running, jobs which are still scheduled are discarded """
+        with self.condition:
+            self.stopped = True
+            self.condition.notify()
+
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def call_later(self, delay, callback, name=None):
+        return self.schedule(Job(self, callback, None, name, clock() + delay))
+
+    def call_every(self, interval, callback, name=None, delay=None):
+        """ runs callback every interval seconds, the first time after delay seconds (default the interval) """
+        due = clock() + (interval if delay is None else delay)
+        return self.schedule(Job(self, callback, interval, name, due))
+
+    def schedule(self, job):
+        with self.condition:
+            self.push(job)
+            # only wake up the thread when the new job is due before the job it is waiting for
+            if self.heap[0][2] is job:
+                self.condition.notify()
+
+        return job
+
+    def cancel(self, job):
+        with self.condition:
+            if job.cancelled:
+                return
+
+            job.cancelled = True
+            if job.due is None:
+                return  # ran already
+
+            self.cancelled += 1
+            # cancelled jobs are removed lazily, unless they make up most of the heap (batches flushed before they are due)
+            if self.cancelled > 64 and self.cancelled > len(self.heap) // 2:
+                self.heap = [entry for entry in self.heap if not entry[2].cancelled]
+                heapq.heapify(self.heap)
+                self.cancelled = 0
+
+    def push(self, job):
+        heapq.heappush(self.heap, (job.due, self.sequence, job))
+        self.sequence += 1
+
+    def next_job(self):
+        """ waits until a job is due and returns it, or returns None when stopped """
+        with self.condition:
+            while not self.stopped:
+                # cancelled jobs are only removed when they reach the top of the heap
+                while self.heap and self.heap[0][2].cancelled:
+                    heapq.heappop(self.heap)
+                    self.cancelled -= 1
+
+                if not self.heap:
+                    self.condition.wait()
+                    continue
+
+                due, _, job = self.heap[0]
+                now = clock()
+                if due > now:
+                    self.condition.wait(due - now)
+                    continue
+
+                heapq.heappop(self.heap)
+                if job.interval is not None:
+                    job.due = due + job.interval
+                    if job.due <= now:
+                        job.due = now + job.interval  # fell behind, skip the missed runs
+                    self.push(job)
+                else:
+                    job.due = None
+
+                return job, now - due
+
+            return None
+
+    def run(self):
+        while True:
+            next_job = self.next_job()
+            if next_job is None:
+                return
+
+            job, late = next_job
+            if self.lateness is not None:
+                self.lateness.observe(late)
+
+            try:
+                job.callback()
+            except Exception:
+                self.errors += 1
+                lines = traceback.format_exception(*sys.exc_info())
+                logger.error("Exception in scheduled job {}: \n{}".format(job.name, "".join(lines)))
+
+            self.runs += 1
+
+    def stats(self):
+        return {
+            'jobs': len(self.heap),
+            'runs': self.runs,
+            'errors': self.errors
+        }
+
+
+_shared = None
+_shared_lock = Lock()
+
+
+def shared_scheduler():
+    """ the scheduler used by components which are not given one, started when it is first used """
+    global _shared
+    with _shared_lock:
+        if _shared is None:
+            _shared = Scheduler("shared-scheduler").start()
+
+        return _shared
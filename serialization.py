@@ -0,0 +1,134 @@
+import binascii
+import json
+from enum import Enum
+
+from d7a.alp.command import Command
+from d7a.alp.operands.file import Data
+from d7a.d7anp.addressee import Addressee
+from d7a.sp.status import Status
+
+from alp_util import length_value
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Serializes the payloads we send to Thingsboard and MQTT as JSON. Objects which are not natively supported by
+# the JSON encoder (the pyd7a objects) are converted by an encoder function looked up by type. Encoders for the
+# objects we send on every packet are defined explicitly below, for other types an encoder copying the public
+# attributes is generated the first time the type is encountered and cached.
+
+_encoders = {}
+_cache = {}
+
+
+def encoder(cls):
+    """ decorator registering a function converting instances of cls (and subclasses) to JSON compatible objects """
+    def register(fn):
+        _encoders[cls] = fn
+        _cache.clear()
+        return fn
+
+    return register
+
+
+def _attribute_encoder(cls):
+    fields = []  # public attribute names, determined from the first instance encoded
+
+    def encode(obj):
+        if not fields:
+            fields.extend(sorted(name for name, value in vars(obj).items()
+                                 if not name.startswith("_") and not callable(value)))
+
+        return dict((name, getattr(obj, name, None)) for name in fields)
+
+    return encode
+
+
+def _lookup(cls):
+    fn = _cache.get(cls)
+    if fn is None:
+        for base in cls.__mro__:
+            if base in _encoders:
+                fn = _encoders[base]
+                break
+        else:
+            fn = _attribute_encoder(cls)
+
+        _cache[cls] = fn
+
+    return fn
+
+
+def _default(obj):
+    if isinstance(obj, (bytes, bytearray)):
+        return binascii.hexlify(obj).decode("ascii")
+
+    if isinstance(obj, Enum):
+        return obj.value
+
+    if isinstance(obj, (set, frozenset, tuple)):
+        return list(obj)
+
+    if not hasattr(obj, "__dict__"):
+        raise TypeError("Object of type {} is not JSON serializable".format(type(obj).__name__))
+
+    return _lookup(type(obj))(obj)
+
+
+if orjson is not None:
+    def dumps(obj):
+        """ returns obj encoded as JSON (utf-8 bytes) """
+        return orjson.dumps(obj, default=_default, option=orjson.OPT_NON_STR_KEYS)
+else:
+    _json_encoder = json.JSONEncoder(default=_default, separators=(",", ":"))
+
+    def dumps(obj):
+        """ returns obj encoded as JSON (utf-8 bytes) """
+        return _json_encoder.encode(obj).encode("utf-8")
+
+
+@encoder(Command)
+def _encode_command(cmd):
+    return {
+        "tag_id": getattr(cmd, "tag_id", None),
+        "actions": [action.operation for action in cmd.actions],
+        "interface_status": cmd.interface_status.operand if cmd.interface_status is not None else None
+    }
+
+
+@encoder(Data)
+def _encode_file_data(data):
+    return {
+        "file_id": data.offset.id,
+        "offset": length_value(data.offset.offset),
+        "length": length_value(data.length),
+        "data": list(data.data)
+    }
+
+
+@encoder(Status)
+def _encode_interface_status(status):
+    return {
+        "addressee": status.addressee,
+        "channel": status.get_short_channel_string(),
+        "rx_level": status.rx_level,
+        "link_budget": status.link_budget,
+        "target_rx_level": status.target_rx_level,
+        "nls": status.nls,
+        "missed": status.missed,
+        "retry": status.retry,
+        "unicast": status.unicast,
+        "fifo_token": status.fifo_token,
+        "seq_nr": status.seq_nr
+    }
+
+
+@encoder(Addressee)
+def _encode_addressee(addressee):
+    return {
+        "id": "{:x}".format(addressee.id) if addressee.id is not None else None,
+        "id_type": addressee.id_type,
+        "access_class": addressee.access_class
+    }
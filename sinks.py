@@ -0,0 +1,283 @@
+import binascii
+import json
+import logging
+import os
+import time
+
+import serialization
+from mqtt_class import Mqtt, RawForwarder
+from mqtt_connection import Backoff
+from pipeline import Stage, OVERFLOW_DROP_OLDEST
+
+logger = logging.getLogger(__name__)
+
+# Destinations of the frames leaving the pipeline. Every sink has a stage of its own (a bounded queue and a worker
+# thread), so a slow or unreachable destination only backs up its own queue. Extra sinks are configured in a JSON file:
+#
+#   {"sinks": [
+#     {"type": "file", "name": "json", "path": "/var/lib/d7-gateway/frames-%Y-%m-%d.jsonl"},
+#     {"type": "archive", "name": "backup-archive", "path": "/mnt/backup/archive", "max_size": 1024, "max_age": 30},
+#     {"type": "mqtt", "name": "backup", "broker": "broker.example.com", "port": 1883, "topic": "/d7", "qos": 1,
+#      "queue_size": 10000, "overflow": "spill", "retries": 3}
+#   ]}
+#
+# queue_size, overflow and retries can be set for every sink, the other options depend on the type. The name defaults to
+# the type and has to be unique, the archive enabled with --archive-dir is named "archive".
+
+
+class Sink:
+    """ a destination for frames, send() is called on the worker thread of the sink and may raise to be retried """
+    def __init__(self, name):
+        self.name = name
+
+    def send(self, frame):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class ThingsboardSink(Sink):
+    """
+    Sends a frame in up to three messages. When one of them fails the frame is retried from that message on, so the
+    messages sent before are not sent again.
+    """
+    def __init__(self, tb, aggregator=None, name="thingsboard"):
+        Sink.__init__(self, name)
+        self.tb = tb
+        self.aggregator = aggregator
+        self.frame = None  # the frame being sent and the messages of it which were not sent yet
+        self.pending = []
+
+    def send(self, frame):
+        if frame is not self.frame:
+            self.frame = frame
+            self.pending = self.messages(frame)
+
+        while self.pending:
+            self.pending[0]()
+            self.pending.pop(0)
+
+        self.frame = None
+
+    def messages(self, frame):
+        messages = []
+        if frame.gw_attributes:
+            messages.append(lambda: self.tb.sendGwAttributes(frame.gw_attributes))
+
+        telemetry = frame.device_telemetry
+        # frames replayed from the archive carry old timestamps, they would close the live windows, so they are sent raw
+        if telemetry and self.aggregator is not None and not frame.replayed:
+            # a duplicate frame is not counted again in the aggregates
+            if frame.duplicate:
+                telemetry = self.aggregator.passthrough(frame.node_id, telemetry)
+            else:
+                telemetry = self.aggregator.add(frame.node_id, frame.timestamp, telemetry)
+        if telemetry:
+            messages.append(lambda: self.tb.sendDeviceTelemetry(frame.node_id, frame.timestamp, telemetry))
+        if frame.device_attributes:
+            messages.append(lambda: self.tb.sendDeviceAttributes(frame.node_id, frame.device_attributes))
+
+        return messages
+
+
+class MqttSink(Sink):
+    """ publishes the raw ALP commands, and in save bandwidth mode the binary uplink blobs, to an MQTT broker """
+    def __init__(self, forwarder, binary_uplink=None, connection=None, name="mqtt"):
+        Sink.__init__(self, name)
+        self.forwarder = forwarder
+        self.binary_uplink = binary_uplink
+        self.connection = connection  # disconnected on close when the sink owns it
+
+    def send(self, frame):
+        # frames replayed from the archive were published when they were received
+        if frame.replayed:
+            return
+
+        # publish raw ALP command to MQTT broker on topic "/d7/<node_id>/<gateway_id>", buffered while disconnected
+        if not frame.binary and not frame.duplicate:
+            self.forwarder.forward(frame.node_id, frame.modem_uid, frame.timestamp, binascii.hexlify(frame.raw()))
+
+        if frame.binary and self.binary_uplink is not None:
+            self.binary_uplink.add(frame.modem_uid, frame.timestamp, frame.raw())
+
+    def close(self):
+        if self.binary_uplink is not None:
+            self.binary_uplink.flush()
+        self.forwarder.flush()
+        if self.connection is not None:
+            self.connection.disconnect()
+
+
+class FileSink(Sink):
+    """
+    Archives frames as JSON lines. The path is formatted with strftime, so a pattern like frames-%Y-%m-%d.jsonl starts
+    a new file every day.
+    """
+    def __init__(self, path, name="file"):
+        Sink.__init__(self, name)
+        self.path = path
+        self.current_path = None
+        self.file = None
+
+    def send(self, frame):
+        if frame.duplicate:
+            return
+
+        path = time.strftime(self.path, time.localtime(frame.timestamp / 1000.0))
+        if path != self.current_path:
+            self.close()
+            directory = os.path.dirname(path)
+            if directory and not os.path.isdir(directory):
+                os.makedirs(directory)
+
+            self.file = open(path, "ab")
+            self.current_path = path
+
+        self.file.write(serialization.dumps({
+            'ts': frame.timestamp,
+            'modem': frame.modem_uid,
+            'node': frame.node_id,
+            'alp': binascii.hexlify(frame.raw()).decode("ascii"),
+            'telemetry': frame.device_telemetry,
+            'attributes': frame.device_attributes
+        }) + b"\n")
+        self.file.flush()
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+            self.current_path = None
+
+
+class ArchiveSink(Sink):
+    """ appends the raw ALP commands to a FrameArchive, from which they can be replayed """
+    def __init__(self, archive, name="archive"):
+        Sink.__init__(self, name)
+        self.archive = archive
+
+    def send(self, frame):
+        if frame.duplicate or frame.replayed:
+            return
+
+        self.archive.append(frame.timestamp, frame.modem_uid, frame.node_id, frame.raw())
+
+    def close(self):
+        self.archive.close()
+
+
+def _mqtt_sink(name, config, scheduler):
+    connection = Mqtt(config["broker"], int(config.get("port", 1883)), qos=config.get("qos", 0),
+                      buffer_size=config.get("buffer_size", 10000), max_inflight=config.get("inflight", 20))
+    forwarder = RawForwarder(connection, config.get("topic", "/d7"), config.get("aggregate_interval", 0),
+                             config.get("aggregate_max", 100), scheduler)
+    return MqttSink(forwarder, connection=connection, name=name)
+
+
+def _archive_sink(name, config, scheduler):
+    from frame_archive import FrameArchive
+
+    # max_size in MB, max_age in days
+    archive = FrameArchive(config["path"], max_bytes=int(config.get("max_size", 1024) * 1024 * 1024),
+                           max_age_seconds=config.get("max_age", 0) * 24 * 3600)
+    return ArchiveSink(archive, name=name)
+
+
+# sink type -> function creating the sink from its name, configuration and the scheduler for periodic work, extend to add
+# destinations
+SINK_TYPES = {
+    "file": lambda name, config, scheduler: FileSink(config["path"], name=name),
+    "mqtt": _mqtt_sink,
+    "archive": _archive_sink
+}
+
+
+def load_sinks(path, scheduler=None):
+    """ returns (sink, queue size, overflow policy, retries) for every sink in the configuration file """
+    with open(path) as f:
+        config = json.load(f)
+
+    sinks = []
+    for sink_config in config["sinks"]:
+        sink_type = sink_config["type"]
+        if sink_type not in SINK_TYPES:
+            raise ValueError("unknown sink type {}".format(sink_type))
+
+        name = sink_config.get("name", sink_type)
+        sinks.append((SINK_TYPES[sink_type](name, sink_config, scheduler), sink_config.get("queue_size", 1000),
+                      sink_config.get("overflow", OVERFLOW_DROP_OLDEST), sink_config.get("retries", 3)))
+
+    return sinks
+
+
+class Sinks:
+    """
+    fans frames out to the sinks, put() only queues the frame on the stage of every sink. When set, on_delivered(sink, frame)
+    is called on the worker thread of the sink after it sent a frame.
+    """
+    def __init__(self, spill_dir="", on_delivered=None):
+        self.spill_dir = spill_dir
+        self.on_delivered = on_delivered
+        self.sinks = []
+        self.stages = []
+
+    def add(self, sink, max_size=1000, overflow=OVERFLOW_DROP_OLDEST, retries=3):
+        # the stats and metrics are reported per sink name
+        if any(existing.name == sink.name for existing in self.sinks):
+            raise ValueError("duplicate sink name {}".format(sink.name))
+
+        def deliver(frame):
+            backoff = Backoff(initial_seconds=0.5, max_seconds=30)
+            for attempt in range(retries + 1):
+                try:
+                    sink.send(frame)
+                except Exception as e:
+                    if attempt == retries:
+                        raise
+
+                    delay = backoff.next()
+                    logger.warning("Sink {} failed: {}, retrying in {:.1f} s".format(sink.name, e, delay))
+                    time.sleep(delay)
+                    continue
+
+                if self.on_delivered is not None:
+                    self.on_delivered(sink, frame)
+                return
+
+        self.sinks.append(sink)
+        self.stages.append(Stage("sink-" + sink.name, deliver, workers=1, max_size=max_size, overflow=overflow,
+                                 spill_dir=self.spill_dir))
+        logger.info("Forwarding frames to sink {} ({})".format(sink.name, type(sink).__name__))
+
+    def start(self):
+        for stage in self.stages:
+            stage.start()
+
+    def stop(self):
+        for stage in self.stages:
+            stage.stop()
+
+        for sink in self.sinks:
+            try:
+                sink.close()
+            except Exception:
+                logger.exception("Could not close sink {}".format(sink.name))
+
+    def put(self, frame):
+        for stage in self.stages:
+            stage.put(frame)
+
+    def stats(self):
+        return dict((sink.name, stage.stats()) for sink, stage in zip(self.sinks, self.stages))
+
+    def instrument(self, metrics):
+        duration = metrics.histogram("sink_seconds", "Time spent delivering a frame per sink")
+        for stage in self.stages:
+            stage.duration = duration
+
+        metrics.gauge("sink_depth", "Sink queue depth",
+                      lambda: dict((sink, stats["depth"]) for sink, stats in self.stats().items()), label="sink")
+        for name in ["processed", "dropped", "errors"]:
+            metrics.counter("sink_{}_total".format(name), "Sink queue {}".format(name),
+                            lambda name=name: dict((sink, stats[name]) for sink, stats in self.stats().items()), label="sink")
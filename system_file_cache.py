@@ -0,0 +1,74 @@
+import json
+import logging
+import os
+import time
+from threading import Lock
+
+from scheduler import shared_scheduler
+
+logger = logging.getLogger(__name__)
+
+
+class SystemFileCache:
+    """
+    Remembers the parsed system files of the modems on disk, so they do not all have to be read again after a restart.
+    Entries are stored per modem UID and firmware version: a firmware update invalidates the files of that modem.
+    Files read longer than max_age_seconds ago are considered stale and read again. Values are stored as JSON, as they
+    are sent to Thingsboard. Changes are saved by the scheduler every save_interval_seconds.
+    """
+    def __init__(self, path, max_age_seconds=24 * 3600, save_interval_seconds=5, scheduler=None):
+        self.path = path
+        self.max_age = max_age_seconds
+        self.entries = {}  # "<uid>/<firmware version>" -> {file id: {"ts": read time, "value": value}}
+        self.lock = Lock()
+        self.dirty = False
+        self.load()
+        scheduler = scheduler if scheduler is not None else shared_scheduler()
+        self.job = scheduler.call_every(save_interval_seconds, self.save, "system-file-cache")
+
+    @staticmethod
+    def key(uid, firmware_version):
+        return "{}/{}".format(uid, firmware_version)
+
+    def load(self):
+        try:
+            with open(self.path) as f:
+                self.entries = json.load(f)
+        except (IOError, OSError):
+            self.entries = {}
+        except ValueError as e:
+            logger.warning("Ignoring corrupt system file cache {}: {}".format(self.path, e))
+            self.entries = {}
+
+    def save(self):
+        with self.lock:
+            if not self.dirty:
+                return
+
+            data = json.dumps(self.entries)
+            self.dirty = False
+
+        # write to a temporary file first, so a crash never leaves a truncated cache
+        tmp_path = self.path + ".tmp"
+        try:
+            with open(tmp_path, "w") as f:
+                f.write(data)
+            os.rename(tmp_path, self.path)
+        except (IOError, OSError) as e:
+            logger.warning("Could not save system file cache {}: {}".format(self.path, e))
+
+    def close(self):
+        self.job.cancel()
+        self.save()
+
+    def fresh(self, uid, firmware_version, now=None):
+        """ returns the file ID -> value of the files which were read recently """
+        now = now if now is not None else time.time()
+        with self.lock:
+            files = self.entries.get(self.key(uid, firmware_version), {})
+            return dict((int(file_id), entry["value"]) for file_id, entry in files.items() if now - entry["ts"] < self.max_age)
+
+    def update(self, uid, firmware_version, file_id, value):
+        with self.lock:
+            self.entries.setdefault(self.key(uid, firmware_version), {})[str(file_id)] = {"ts": time.time(), "value": value}
+            self.dirty = True
@@ -0,0 +1,41 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from aggregation import Aggregator, Rule
+
+
+class AggregatorTest(unittest.TestCase):
+    def setUp(self):
+        self.published = []
+        self.aggregator = Aggregator([Rule(key="lb", window=60, functions=["mean", "count"])],
+                                     lambda device, window_start, values: self.published.append((window_start, values)),
+                                     scheduler=object())
+
+    def test_closes_window_on_later_sample(self):
+        for i in range(4):
+            self.assertEqual(self.aggregator.add("node", i * 1000, {"lb": 10}), {})
+
+        self.aggregator.add("node", 60000, {"lb": 20})
+        self.assertEqual(self.published, [(0, {"lb_mean": 10.0, "lb_count": 4})])
+
+    def test_late_sample_of_closed_window_is_passed_through(self):
+        for i in range(4):
+            self.aggregator.add("node", i * 1000, {"lb": 10})
+        self.aggregator.add("node", 60000, {"lb": 20})
+
+        # a sample of window 0 arriving after window 1 was opened
+        self.assertEqual(self.aggregator.add("node", 5000, {"lb": 99}), {"lb": 99})
+        self.aggregator.flush()
+        # a sample of a window closed by the flush
+        self.assertEqual(self.aggregator.add("node", 61000, {"lb": 99}), {"lb": 99})
+
+        self.assertEqual(self.published, [(0, {"lb_mean": 10.0, "lb_count": 4}),
+                                          (60000, {"lb_mean": 20.0, "lb_count": 1})])
+        self.assertEqual(self.aggregator.late, 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,32 +1,61 @@
 import logging
+import time
 import paho.mqtt.client as mqtt
-from threading import Timer
+from threading import Lock, Thread, Condition
 from datetime import datetime
 
+import serialization
+from mqtt_connection import MqttConnection
+from offline_queue import OfflineQueue, EVICT_DROP_OLDEST
+from scheduler import shared_scheduler
+
 logger = logging.getLogger(__name__)
 
+PRIORITY_ATTRIBUTES = 0
+PRIORITY_TELEMETRY = 1
+
 class Thingsboard():
-    def __init__(self, broker, token, mqttCallbackFunction, persistData=True, heartbeat_interval_seconds=5):
+    def __init__(self, broker, token, mqttCallbackFunction, persistData=True, heartbeat_interval_seconds=5,
+                 batch_interval_seconds=0, batch_max_size=100, queue_file="offline-queue.db",
+                 queue_max_messages=100000, queue_max_bytes=50 * 1024 * 1024, queue_eviction=EVICT_DROP_OLDEST,
+                 queue_flush_window=20, attribute_cache=None, connect_timeout_seconds=10, scheduler=None):
         self.gwReportTimeout = heartbeat_interval_seconds
+        # the heartbeat and the batch flushes run on the scheduler instead of a timer thread each
+        self.scheduler = scheduler if scheduler is not None else shared_scheduler()
         self.log = logger
         self.connected_to_mqtt = False
         self.broker = broker
         self.token = token
         self.mqttCallback = mqttCallbackFunction
         self.persistData = persistData
+        self.connect_timeout = connect_timeout_seconds
         if self.persistData:
-            self.gw_telemetry_queue = []
-            self.gw_attributes_queue = []
-            self.device_telemetry_queue = []
-            self.device_attributes_queue = []
-            #TODO: set maximum queue sizes?
+            # messages which could not be sent are stored on disk and only removed after the broker acknowledged them
+            self.queue = OfflineQueue(queue_file, max_messages=queue_max_messages, max_bytes=queue_max_bytes,
+                                      eviction=queue_eviction)
+            self.queue_flush_window = queue_flush_window
+            self.queue_inflight = {}  # mid -> queue id
+            self.queue_acked = set()  # mids acknowledged before publish() returned
+            self.queue_condition = Condition()
+            self.queue_flusher = None
 
-        try:
-            self.connectMqtt()
-        except:
-            self.log.warning("Can't connect to MQTT broker")
+        # optional histograms, set by instrument()
+        self.serialize_time = None
+        self.publish_time = None
+        self.published = 0
+        self.acknowledged = 0
 
-        self.start_report_timer()
+        # when set, attributes equal to the last published value are not sent again
+        self.attribute_cache = attribute_cache
+
+        # when batching is enabled values are merged per device and flushed as one message per topic,
+        # either when the flush window expires or when batch_max_size values are pending
+        self.batching = batch_interval_seconds > 0
+        self.batch_interval = batch_interval_seconds
+        self.batch_max_size = batch_max_size
+        self.batch_lock = Lock()
+        self.batch_timer = None
+        self.resetBatch()
 
         self.GATEWAY_ATTRIBUTES_TOPIC = "v1/gateway/attributes"
         self.GATEWAY_TELEMETRY_TOPIC = "v1/gateway/telemetry"
@@ -34,6 +63,9 @@ class Thingsboard():
         self.DEVICE_ATTRIBUTES_TOPIC = "v1/devices/me/attributes"
         self.DEVICE_TELEMETRY_TOPIC = "v1/devices/me/telemetry"
 
+        self.connectMqtt()
+        self.start_report_timer()
+
         self.log.info("ThingsBoard GW started")
 
     #TODO: Handle RPC commands from TB
@@ -43,95 +75,269 @@ class Thingsboard():
         self.mq.username_pw_set(self.token)
         self.mq.on_connect = self.onMqttConnect
         self.mq.on_disconnect = self.onMqttDisconnect
+        self.mq.on_publish = self.onMqttPublish
         self.mq.on_message = self.mqttCallback
-        self.mq.subscribe("v1/gateway/rpc", qos=1)
-        try:
-            self.mq.connect(self.broker, 1883, keepalive=0)
-            self.mq.loop_start()
-            while not self.connected_to_mqtt: pass  # busy wait until connected
-        except:
-            self.log.warning("Failed to connect MQTT broker")
-            self.connected_to_mqtt = False
-            raise
+        # connects in the background and reconnects with exponential backoff, messages are queued until connected
+        self.connection = MqttConnection(self.mq, self.broker, 1883, connect_timeout=self.connect_timeout, name="tb-mqtt")
+        self.connection.start()
 
     def onMqttConnect(self, client, userdata, flags_dict, rc):
+        if rc != mqtt.MQTT_ERR_SUCCESS:
+            return
+
         self.connected_to_mqtt = True
         self.log.info("MQTT broker connected")
+        self.mq.subscribe(self.GATEWAY_RPC_TOPIC, qos=1)
+        if self.attribute_cache is not None and not self.persistData:
+            # attributes published while disconnected were dropped, the cache is filled again by the next updates
+            self.attribute_cache.clear()
         if self.persistData and self.checkQueue():
             self.flushQueues()
 
     def onMqttDisconnect(self, client, userdata, rc):
         self.connected_to_mqtt = False
         self.log.warning("MQTT broker disconnected")
+        if self.persistData:
+            # paho resends the unacknowledged messages after reconnecting, under the same mid, so the queued messages in
+            # flight stay in flight and are removed from disk when they are acknowledged
+            with self.queue_condition:
+                self.queue_acked.clear()
+                self.queue_condition.notify_all()
 
-    def sendGwAttributes(self, values):
+    def onMqttPublish(self, client, userdata, mid):
+        self.acknowledged += 1
+        if not self.persistData:
+            return
+
+        with self.queue_condition:
+            id = self.queue_inflight.pop(mid, None)
+            if id is None:
+                if self.queue_flusher is not None:
+                    self.queue_acked.add(mid)
+                return
+
+            if not self.queue_inflight:
+                self.queue_condition.notify_all()
+
+        self.queue.ack(id)
+
+    def encode(self, values):
+        if self.serialize_time is None:
+            return serialization.dumps(values)
+
+        start = time.time()
+        msg = serialization.dumps(values)
+        self.serialize_time.observe(time.time() - start)
+        return msg
+
+    def publish(self, topic, msg, priority):
         if self.connected_to_mqtt:
-            msg = str(values)
-            self.mq.publish(self.DEVICE_ATTRIBUTES_TOPIC, msg, qos=1)
+            start = time.time()
+            info = self.mq.publish(topic, msg, qos=1)
+            if self.publish_time is not None:
+                self.publish_time.observe(time.time() - start)
+
+            # when the connection was lost meanwhile paho keeps the message and sends it after reconnecting
+            if info.rc in (mqtt.MQTT_ERR_SUCCESS, mqtt.MQTT_ERR_NO_CONN):
+                self.published += 1
+                return True
+
+        if self.persistData:
+            self.queue.put(topic, msg, priority)
+            self.log.info("MQTT disconnected, message added to queue ({} queued)".format(len(self.queue)))
+
+        return False
+
+    def sendGwAttributes(self, values):
+        if self.attribute_cache is not None:
+            values = self.attribute_cache.changed(None, values)
+            if not values:
+                return
+
+        if self.batching:
+            self.addToBatch(self.gw_attributes_batch.update, values, len(values))
+            return
+
+        if self.publish(self.DEVICE_ATTRIBUTES_TOPIC, self.encode(values), PRIORITY_ATTRIBUTES):
             self.log.debug("Attributes sent to TB gateway")
-        else:
-            self.gw_attributes_queue.append(values)
-            self.log.info("MQTT disconnected, attributes added to queue")
 
     def sendGwTelemetry(self, values):
-        if self.connected_to_mqtt:
-            msg = str(values)
-            self.mq.publish(self.DEVICE_TELEMETRY_TOPIC, msg, qos=1)
-            self.log.debug("Attributes sent to TB gateway")
-        elif self.persistData:
-            self.gw_telemetry_queue.append(values)
-            self.log.info("MQTT disconnected, telemetry added to queue")
+        if self.batching:
+            timestamp = int(round(time.time() * 1000))
+            self.addToBatch(lambda v: self.gw_telemetry_batch.setdefault(timestamp, {}).update(v), values, len(values))
+            return
+
+        if self.publish(self.DEVICE_TELEMETRY_TOPIC, self.encode(values), PRIORITY_TELEMETRY):
+            self.log.debug("Telemetry sent to TB gateway")
 
     def sendDeviceAttributes(self, device, values):
-        if self.connected_to_mqtt:
-            msg = "{{'{}': {}}}".format(device, values)
-            self.mq.publish(self.GATEWAY_ATTRIBUTES_TOPIC, msg, qos=1)
+        if self.attribute_cache is not None:
+            values = self.attribute_cache.changed(device, values)
+            if not values:
+                return
+
+        if self.batching:
+            self.addToBatch(lambda v: self.device_attributes_batch.setdefault(device, {}).update(v), values, len(values))
+            return
+
+        msg = self.encode({device: values})
+        if self.publish(self.GATEWAY_ATTRIBUTES_TOPIC, msg, PRIORITY_ATTRIBUTES):
             self.log.debug("Attributes sent to TB device")
-        else:
-            self.device_attributes_queue.append([device, values])
-            self.log.info("MQTT disconnected, attributes added to queue")
 
     def sendDeviceTelemetry(self, device, timestamp, values):
-        if self.connected_to_mqtt:
-            msg = "{{'{}': [{{'ts': {}, 'values': {}}}]}}".format(device, timestamp, values)
-            self.mq.publish(self.GATEWAY_TELEMETRY_TOPIC, msg, qos=1)
+        if self.batching:
+            self.addToBatch(lambda v: self.device_telemetry_batch.setdefault(device, {}).setdefault(timestamp, {}).update(v),
+                            values, len(values))
+            return
+
+        msg = self.encode({device: [{'ts': timestamp, 'values': values}]})
+        if self.publish(self.GATEWAY_TELEMETRY_TOPIC, msg, PRIORITY_TELEMETRY):
             self.log.debug("Telemetry sent to TB device")
-        elif self.persistData:
-            self.device_telemetry_queue.append([device, timestamp, values])
-            self.log.info("MQTT disconnected, telemetry added to queue")
+
+    def sendRpcResponse(self, device, request_id, data):
+        msg = self.encode({'device': device, 'id': request_id, 'data': data})
+        if self.publish(self.GATEWAY_RPC_TOPIC, msg, PRIORITY_ATTRIBUTES):
+            self.log.debug("RPC response sent to TB device")
+
+    def resetBatch(self):
+        self.gw_attributes_batch = {}
+        self.gw_telemetry_batch = {}  # ts -> values
+        self.device_attributes_batch = {}  # device -> values
+        self.device_telemetry_batch = {}  # device -> ts -> values
+        self.batch_size = 0
+
+    def addToBatch(self, merge, values, size):
+        with self.batch_lock:
+            merge(values)
+            self.batch_size += size
+            flush_now = self.batch_size >= self.batch_max_size
+            if not flush_now and self.batch_timer is None:
+                self.batch_timer = self.scheduler.call_later(self.batch_interval, self.flushBatch, "tb-batch")
+
+        if flush_now:
+            self.flushBatch()
+
+    def flushBatch(self):
+        with self.batch_lock:
+            if self.batch_timer is not None:
+                self.batch_timer.cancel()
+                self.batch_timer = None
+
+            if self.batch_size == 0:
+                return
+
+            gw_attributes = self.gw_attributes_batch
+            gw_telemetry = self.gw_telemetry_batch
+            device_attributes = self.device_attributes_batch
+            device_telemetry = self.device_telemetry_batch
+            batch_size = self.batch_size
+            self.resetBatch()
+
+        if gw_attributes:
+            self.publish(self.DEVICE_ATTRIBUTES_TOPIC, self.encode(gw_attributes), PRIORITY_ATTRIBUTES)
+        if gw_telemetry:
+            msg = self.encode([{'ts': ts, 'values': gw_telemetry[ts]} for ts in sorted(gw_telemetry)])
+            self.publish(self.DEVICE_TELEMETRY_TOPIC, msg, PRIORITY_TELEMETRY)
+        if device_attributes:
+            self.publish(self.GATEWAY_ATTRIBUTES_TOPIC, self.encode(device_attributes), PRIORITY_ATTRIBUTES)
+        if device_telemetry:
+            msg = self.encode(dict((device, [{'ts': ts, 'values': samples[ts]} for ts in sorted(samples)])
+                           for device, samples in device_telemetry.items()))
+            self.publish(self.GATEWAY_TELEMETRY_TOPIC, msg, PRIORITY_TELEMETRY)
+
+        self.log.debug("Batch of {} values sent to TB".format(batch_size))
+
+    def instrument(self, metrics):
+        self.serialize_time = metrics.histogram("serialize_seconds", "Time spent encoding a Thingsboard message")
+        self.publish_time = metrics.histogram("publish_seconds", "Time spent handing a message to the MQTT client")
+        metrics.gauge("tb_connected", "Connected to the Thingsboard MQTT broker", lambda: int(self.connected_to_mqtt))
+        metrics.counter("tb_published_total", "Messages published to Thingsboard", lambda: self.published)
+        metrics.gauge("tb_inflight", "Messages published to Thingsboard and not yet acknowledged",
+                      lambda: self.published - self.acknowledged)
+        metrics.counter("tb_reconnects_total", "Reconnections to the Thingsboard MQTT broker", lambda: self.connection.reconnects)
+        if self.persistData:
+            metrics.gauge("offline_queue_messages", "Messages in the offline queue", lambda: len(self.queue))
+            metrics.gauge("offline_queue_bytes", "Size of the messages in the offline queue", lambda: self.queue.bytes)
+            metrics.counter("offline_queue_evicted_total", "Messages evicted from the full offline queue", lambda: self.queue.evicted)
+        if self.attribute_cache is not None:
+            metrics.counter("attribute_cache_suppressed_total", "Unchanged attributes which were not sent",
+                            lambda: self.attribute_cache.hits)
 
     def checkQueue(self):
-        if not self.device_telemetry_queue and not self.gw_telemetry_queue and not self.device_attributes_queue and not self.gw_attributes_queue:
-            return False
-        else: return True
+        return len(self.queue) > 0
 
     def flushQueues(self):
-        for msg in self.gw_telemetry_queue: self.sendGwTelemetry(msg)
-        self.gw_telemetry_queue = []
-        for msg in self.device_telemetry_queue: self.sendDeviceTelemetry(msg[0], msg[1], msg[2])
-        self.device_telemetry_queue = []
-        for msg in self.gw_attributes_queue: self.sendGwAttributes(msg)
-        self.gw_attributes_queue = []
-        for msg in self.device_attributes_queue: self.sendDeviceAttributes(msg[0], msg[1])
-        self.device_attributes_queue = []
-        self.log.info("Queued messages sent to Thingsboard")
+        # drain the queue from a separate thread, so the paho network thread is free to process the acknowledgements
+        with self.queue_condition:
+            if self.queue_flusher is not None:
+                return
+
+            self.queue_flusher = Thread(target=self.drainQueue, name="tb-queue-flusher")
+            self.queue_flusher.daemon = True
+            self.queue_flusher.start()
+
+    def drainQueue(self):
+        self.log.info("Sending {} queued messages to Thingsboard".format(len(self.queue)))
+        try:
+            while self.connected_to_mqtt and len(self.queue) > 0:
+                # publish a window of queued messages and wait until all of them are acknowledged before continuing,
+                # so only queue_flush_window messages are kept in memory
+                failed = False
+                with self.queue_condition:
+                    inflight = set(self.queue_inflight.values())
+
+                for id, topic, payload in self.queue.peek(self.queue_flush_window):
+                    if id in inflight:
+                        continue  # sent before the connection was lost, paho resends it
+
+                    info = self.mq.publish(topic, payload, qos=1)
+                    if info.rc not in (mqtt.MQTT_ERR_SUCCESS, mqtt.MQTT_ERR_NO_CONN):
+                        failed = True
+                        break
+
+                    self.published += 1
+                    failed = info.rc != mqtt.MQTT_ERR_SUCCESS
+
+                    with self.queue_condition:
+                        if info.mid in self.queue_acked:
+                            self.queue_acked.discard(info.mid)
+                            acked = True
+                        else:
+                            self.queue_inflight[info.mid] = id
+                            acked = False
+
+                    if acked:
+                        self.queue.ack(id)
+
+                    if failed:
+                        break
+
+                with self.queue_condition:
+                    self.queue_acked.clear()
+                    while self.queue_inflight and self.connected_to_mqtt:
+                        self.queue_condition.wait(1)
+
+                if failed:
+                    break  # connection lost, flushed again after reconnecting
+        finally:
+            with self.queue_condition:
+                self.queue_flusher = None
+
+        if len(self.queue) == 0:
+            self.log.info("Queued messages sent to Thingsboard")
 
     def start_report_timer(self):
-        self.report_timer = Timer(self.gwReportTimeout, self.gwReport, ())
-        self.report_timer.start()
+        self.report_timer = self.scheduler.call_every(self.gwReportTimeout, self.gwReport, "tb-heartbeat")
 
     def gwReport(self):
         self.sendGwAttributes({'last_seen': str(datetime.now().strftime("%y-%m-%d %H:%M:%S"))})
-        if self.connected_to_mqtt is False:
-            try:
-                self.connectMqtt()
-            except:
-                self.log.debug("Could not connect to MQTT broker...")
-        self.start_report_timer()
 
     def disconnect(self):
         self.log.info("Disconnecting from ThingsBoard")
-        self.mq.loop_stop()
+        if self.batching:
+            self.flushBatch()
         self.report_timer.cancel()
-        self.mq.disconnect()
+        self.connection.stop()
+        if self.persistData:
+            self.queue.close()
 